@@ -0,0 +1,68 @@
+# ------------------------------------------------------------------------------
+#  Copyright 2020 Forschungszentrum Jülich GmbH and Aix-Marseille Université
+# "Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements; and to You under the Apache License,
+# Version 2.0. "
+#
+# Forschungszentrum Jülich
+# Institute: Institute for Advanced Simulation (IAS)
+# Section: Jülich Supercomputing Centre (JSC)
+# Division: High Performance Computing in Neuroscience
+# Laboratory: Simulation Laboratory Neuroscience
+# Team: Multi-scale Simulation and Design
+# ------------------------------------------------------------------------------
+import numpy as np
+
+# couplings of TVB with an elementwise pre and post: they can be evaluated for several steps
+# at once. The others (Kuramoto, SigmoidalJansenRit, PreSigmoidal, user defined) use the loop.
+BATCHED_COUPLINGS = ('Coupling', 'Linear', 'Scaling', 'HyperbolicTangent', 'Sigmoidal', 'Difference')
+
+
+def initial_coupling(simulator, nb_steps, proxies):
+    """
+    coupling of the proxy nodes for the first steps of the simulation, from the history of TVB
+    :param simulator: configured simulator of TVB
+    :param nb_steps: number of steps, the steps 0 to nb_steps-1
+    :param proxies: index of the proxy nodes
+    :return: coupling (nb_steps * nb coupling variables, nb proxies, nb modes),
+             the same as the concatenation of simulator._loop_compute_node_coupling(step)[:, proxies, :]
+    """
+    proxies = np.asarray(proxies)
+    if not _is_batched(simulator):
+        return np.concatenate([simulator._loop_compute_node_coupling(step)[:, proxies, :]
+                               for step in range(nb_steps)])
+    return _batched_coupling(simulator.coupling, simulator.history, nb_steps, proxies)
+
+
+def _is_batched(simulator):
+    """
+    the coupling can be computed from the delay buffer for all the steps at once:
+    history with the dense arrays, no surface and an elementwise coupling
+    """
+    coupling_type = type(getattr(simulator, 'coupling', None))
+    history = getattr(simulator, 'history', None)
+    return (getattr(simulator, 'surface', None) is None
+            and all(hasattr(history, name) for name in ('buffer', 'n_time', 'es_idelays', 'es_weights'))
+            and coupling_type.__module__ == 'tvb.simulator.coupling'
+            and coupling_type.__name__ in BATCHED_COUPLINGS)
+
+
+def _batched_coupling(coupling, history, nb_steps, proxies):
+    """
+    the coupling (Coupling.__call__ of TVB) of the proxy nodes for all the steps in one array operation
+    """
+    na = np.newaxis
+    steps = np.arange(nb_steps)
+    n_cvar, n_node = history.buffer.shape[1:3]
+    # delayed state: (step, to, ncv, from, m)
+    # NOTE: only the arrays of the history with an axis 'to' are indexed by the proxies, the shape of
+    # es_icvar and es_node_ids depends on the version of TVB ((1, ncv, 1) or (to, ncv, from))
+    time_idx = (steps[:, na, na, na] - 1 - history.es_idelays[proxies][na] + history.n_time) % history.n_time
+    x_j = history.buffer[time_idx, np.arange(n_cvar)[:, na], np.arange(n_node)]
+    # current state: (step, to, ncv, 1, m)
+    x_i = history.buffer[(steps - 1) % history.n_time][:, :, proxies].transpose((0, 2, 1, 3))[:, :, :, na]
+    pre = coupling.pre(x_i, x_j)
+    weighted_sum = (history.es_weights[proxies][na] * pre).sum(axis=3)  # (step, to, ncv, m)
+    result = coupling.post(weighted_sum).transpose((0, 2, 1, 3))  # (step, ncv, to, m)
+    return result.reshape((nb_steps * result.shape[1],) + result.shape[2:])
+
@@ -0,0 +1,195 @@
+# ------------------------------------------------------------------------------
+#  Copyright 2020 Forschungszentrum Jülich GmbH and Aix-Marseille Université
+# "Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements; and to You under the Apache License,
+# Version 2.0. "
+#
+# Forschungszentrum Jülich
+# Institute: Institute for Advanced Simulation (IAS)
+# Section: Jülich Supercomputing Centre (JSC)
+# Division: High Performance Computing in Neuroscience
+# Laboratory: Simulation Laboratory Neuroscience
+# Team: Multi-scale Simulation and Design
+# ------------------------------------------------------------------------------
+import struct
+import numpy as np
+
+
+class MonitorResultStore:
+    """
+    Results of one monitor of TVB, stored in columns: times (n,) and values (n, ...).
+
+    The columns are preallocated for the expected number of samples and grow by
+    chunks if needed, each sample is copied in place: no list of tuples and no
+    concatenation at the end of the simulation.
+
+    With a writer, the samples are flushed every flush_every samples, i.e. the
+    memory is bounded by flush_every samples whatever the length of the simulation.
+    The writer has a method append(times, values) which copies the samples.
+    """
+
+    def __init__(self, nb_samples, writer=None, flush_every=0):
+        """
+        :param nb_samples: expected number of samples, e.g. simulation length / period of the monitor
+        :param writer: destination of the flushed samples (optional)
+        :param flush_every: number of samples between two flushes, 0: flush only on demand
+        """
+        self.__writer = writer
+        self.__flush_every = int(flush_every) if writer is not None else 0
+        self.__capacity = max(1, int(nb_samples))
+        if self.__flush_every > 0:
+            self.__capacity = min(self.__capacity, self.__flush_every)
+        # allocated with the first sample, which gives the shape and the type of the values
+        self.__times = None
+        self.__values = None
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    @property
+    def times(self):
+        """times of the samples in memory (view, valid until the next append)"""
+        if self.__times is None:
+            return np.empty(0)
+        return self.__times[:self.__size]
+
+    @property
+    def values(self):
+        """values of the samples in memory (view, valid until the next append)"""
+        if self.__values is None:
+            return np.empty(0)
+        return self.__values[:self.__size]
+
+    def append(self, time, value):
+        """
+        copy one sample of the monitor
+        :param time: time of the sample
+        :param value: value of the sample, the same shape for all the samples
+        """
+        if self.__values is None:
+            value = np.asarray(value)
+            self.__times = np.empty(self.__capacity)
+            self.__values = np.empty((self.__capacity,) + value.shape, dtype=value.dtype)
+        elif self.__size == self.__times.shape[0]:
+            self.__grow()
+        self.__times[self.__size] = time
+        self.__values[self.__size] = value
+        self.__size += 1
+        if self.__flush_every > 0 and self.__size >= self.__flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        give the samples in memory to the writer, the memory is reused for the next samples
+        """
+        if self.__writer is not None and self.__size > 0:
+            self.__writer.append(self.__times[:self.__size], self.__values[:self.__size])
+            self.__size = 0
+
+    def __grow(self):
+        """
+        more samples than expected: double the capacity (one copy of the samples)
+        """
+        capacity = 2 * self.__times.shape[0]
+        times = np.empty(capacity)
+        times[:self.__size] = self.__times[:self.__size]
+        values = np.empty((capacity,) + self.__values.shape[1:], dtype=self.__values.dtype)
+        values[:self.__size] = self.__values[:self.__size]
+        self.__times, self.__values = times, values
+
+
+class NpyResultWriter:
+    """
+    Samples of one monitor streamed to disk: <prefix>_times.npy and <prefix>_values.npy.
+
+    The samples are appended at the end of the files and the header, which gives
+    the number of samples, is rewritten in place after each append: the files are
+    valid .npy files during the simulation (see read_monitor_results).
+    The writer of a MonitorResultStore (append(times, values)).
+    """
+    # the number of samples of the placeholder header: the longest header of the files
+    MAX_SAMPLES = 10 ** 18
+
+    def __init__(self, prefix):
+        """
+        :param prefix: path and beginning of the name of the files
+        """
+        self.__paths = (prefix + '_times.npy', prefix + '_values.npy')
+        self.__files = None
+        self.__size = 0
+
+    def append(self, times, values):
+        """
+        append samples at the end of the files
+        :param times: times of the samples (n,)
+        :param values: values of the samples (n, ...)
+        """
+        if self.__files is None:
+            self.__open(times, values)
+        for file, (dtype, shape, header_length), data in zip(self.__files, self.__formats, (times, values)):
+            file.write(np.ascontiguousarray(data, dtype=dtype).tobytes())
+        self.__size += times.shape[0]
+        self.__write_headers()
+
+    def close(self):
+        """
+        close the files, they stay readable
+        """
+        if self.__files is not None:
+            for file in self.__files:
+                file.close()
+            self.__files = None
+
+    def __open(self, times, values):
+        """
+        create the files with the type and the shape of the first samples
+        """
+        # type and shape of a sample of each file, the header is reserved for the maximal
+        # number of samples: the data starts after it and does not move
+        self.__formats = [(dtype, shape, len(_npy_header(dtype, (self.MAX_SAMPLES,) + shape)))
+                          for dtype, shape in ((times.dtype, ()), (values.dtype, values.shape[1:]))]
+        self.__files = [open(path, 'wb') for path in self.__paths]
+        self.__write_headers()
+
+    def __write_headers(self):
+        """
+        rewrite the headers with the number of samples, the files are flushed
+        """
+        for file, (dtype, shape, header_length) in zip(self.__files, self.__formats):
+            file.seek(0)
+            file.write(_npy_header(dtype, (self.__size,) + shape, header_length))
+            file.seek(0, 2)
+            file.flush()
+
+
+def _npy_header(dtype, shape, length=None):
+    """
+    header of a .npy file (format 1.0)
+    :param dtype: type of the array
+    :param shape: shape of the array
+    :param length: length of the header in bytes, padded with spaces (default: the shortest aligned length)
+    :return: the header
+    """
+    description = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(int(size) for size in shape))
+    magic = np.lib.format.magic(1, 0)
+    minimal = len(magic) + 2 + len(description) + 1
+    if length is None:
+        # the data is aligned on 64 bytes
+        length = -(-minimal // 64) * 64
+    if length < minimal:
+        raise Exception("header of the .npy file too long: " + str(minimal) + " > " + str(length))
+    description += ' ' * (length - minimal) + '\n'
+    return magic + struct.pack('<H', length - len(magic) - 2) + description.encode('latin1')
+
+
+def read_monitor_results(prefix):
+    """
+    samples of one monitor written by NpyResultWriter, memory-mapped (read only):
+    only the parts used are read from the disk
+    :param prefix: path and beginning of the name of the files
+    :return: times (n,) and values (n, ...) of the samples
+    """
+    return (np.load(prefix + '_times.npy', mmap_mode='r'),
+            np.load(prefix + '_values.npy', mmap_mode='r'))
@@ -151,7 +151,11 @@ class TVBAdapter:
             self._configurations_manager,
             self.__simulator_tvb,
             intercalehub_nest_to_tvb=self.__interscalehub_nest_to_tvb_address,
-            intercalehub_tvb_to_nest=self.__interscalehub_tvb_to_nest_address)
+            intercalehub_tvb_to_nest=self.__interscalehub_tvb_to_nest_address,
+            is_pipelined=bool(self.__sci_params.is_pipelined),
+            is_framed=bool(self.__sci_params.is_framed),
+            # the raw results of the monitors are streamed to the results directory
+            results_path=self.__path_to_parameters_file)
         self.__tvb_mpi_wrapper.init_mpi()
         self.__logger.debug("INIT command is executed")
         return self.__parameters.time_synch  # minimum step size for simulation 
@@ -170,7 +174,8 @@ class TVBAdapter:
             self.__resource_usage_monitor.stop_monitoring()
         self.__logger.info("plotting the result")
         plt.figure(1)
-        plt.plot(p_raw_results[0], raw_results[1][:, 0, :, 0] + 3.0)
+        # the results are memory-mapped: only the plotted variable is read from the disk
+        plt.plot(p_raw_results[0], p_raw_results[1][:, 0, :, 0] + 3.0)
         plt.title("Raw -- State variable 0")
         plt.savefig(self.__parameters.path + "/figures/plot_tvb.png")
         self.__logger.debug("post processing is done")
@@ -11,18 +11,25 @@
 # Laboratory: Simulation Laboratory Neuroscience
 # Team: Multi-scale Simulation and Design
 # ------------------------------------------------------------------------------
+import os
 import sys
 import numpy as np
 from mpi4py import MPI
 
 from EBRAINS_ConfigManager.global_configurations_manager.xml_parsers.default_directories_enum import DefaultDirectories
 from EBRAINS_RichEndpoint.application_companion.common_enums import Response
+from action_adapters_alphabrunel.tvb_simulator.initial_coupling import initial_coupling
+from action_adapters_alphabrunel.tvb_simulator.monitor_result_store import MonitorResultStore, NpyResultWriter, \
+    read_monitor_results
 
 
 class TVBMpiWrapper:
     def __init__(self, log_settings, configurations_manager, simulator_tvb,
                  intercalehub_nest_to_tvb=None,
-                 intercalehub_tvb_to_nest=None) -> None:
+                 intercalehub_tvb_to_nest=None,
+                 is_pipelined=False,
+                 results_path=None,
+                 is_framed=False) -> None:
         self.__logger = configurations_manager.load_log_configurations(
                 name="TVB_MPI_Wrapper",
                 log_configurations=log_settings,
@@ -43,10 +50,50 @@ class TVBMpiWrapper:
         self.__comm_receiver = []
         # sender communicator
         self.__comm_sender = []
+        # protocol of the InterscaleHub:
+        # framed: one message by step and proxy [start_time, end_time, rates...] (Interscale_hub of the demo)
+        # not framed: three messages by step and proxy: times, size and rates (EBRAINS_InterscaleHUB)
+        # NOTE: the framing is kept off until the pivot of EBRAINS_InterscaleHUB supports it
+        self.__is_framed = is_framed
+        # placeholders of the messages, reused at each step
+        self.__receive_frames = []
+        self.__send_frames = []
+        # input of TVB, the rates of all the proxies are copied in place at each step: (steps, 1, proxies, 1)
+        self.__data_value = np.empty((self.__time_synch_n, 1, len(self.__id_proxy), 1))
+        self.__receive_size = np.empty(1, dtype='i')
+        self.__check = np.empty(1, dtype='b')
+        # one byte by proxy for the accepts in flight together (no concurrent receives in one buffer)
+        self.__checks = np.empty(len(self.__id_proxy), dtype='b')
+        self.__request = np.ones(1, dtype='b')
+        # persistent requests of the typed handshake of the framed protocol, reused at each step
+        # NOTE: the handshake of the not framed protocol is pickled (comm.isend / comm.irecv)
+        self.__requests_next_part = []
+        self.__requests_accept = []
+        # pipelined mode: the messages of a step are in flight while TVB integrates,
+        # the send of the output is nonblocking and the receive of the next step is posted in advance
+        # NOTE: the messages in flight need the framed protocol and its typed handshake
+        if is_pipelined and not is_framed:
+            raise Exception("the pipelined mode requires the framed protocol (is_framed)")
+        self.__is_pipelined = is_pipelined
+        # requests in flight, one list by proxy
+        self.__requests_send = []
+        self.__requests_receive = []
         # initialise the variable for the saving the results
+        # one columnar store by monitor, sized from the number of samples of the simulation
+        # with a path, the results are streamed to disk after each synchronization step:
+        # the memory only holds the samples of one step
+        self.__results_prefixes = []
+        self.__result_writers = []
         self.__simulation_results = []
-        for _ in range(self.__nb_monitor):  # the input output monitor
-            self.__simulation_results.append([])
+        for index, monitor in enumerate(self.__simulator_tvb.monitors):  # the input output monitor
+            if results_path is None:
+                self.__simulation_results.append(
+                    MonitorResultStore(np.ceil(self.__simulation_length / monitor.period) + 1))
+            else:
+                self.__results_prefixes.append(os.path.join(results_path, 'tvb_monitor_' + str(index)))
+                self.__result_writers.append(NpyResultWriter(self.__results_prefixes[-1]))
+                self.__simulation_results.append(
+                    MonitorResultStore(np.ceil(self.__time_synch / monitor.period) + 1, self.__result_writers[-1]))
 
     def init_mpi(self):
         """sets up MPI communicators"""
@@ -54,11 +101,22 @@ class TVBMpiWrapper:
         for _ in self.__id_proxy:
             self.__comm_receiver.append(
                 self.__create_mpi_communicator(self.__intercalehub_nest_to_tvb))
+            self.__receive_frames.append(np.empty(self.__time_synch_n + 2, dtype='d'))
+            if self.__is_framed:
+                self.__requests_next_part.append(
+                    self.__comm_receiver[-1].Send_init([self.__request, 1, MPI.BOOL], dest=0, tag=0))
+            self.__requests_receive.append([])
         self.__logger.debug(f"receiver communicators: {self.__comm_receiver}")
         # create sender communicator
-        for _ in self.__id_proxy:
+        for index in range(len(self.__id_proxy)):
             self.__comm_sender.append(
                 self.__create_mpi_communicator(self.__intercalehub_tvb_to_nest))
+            self.__send_frames.append(np.empty(self.__time_synch_n + 2, dtype='d'))
+            if self.__is_framed:
+                self.__requests_accept.append(
+                    self.__comm_sender[-1].Recv_init([self.__checks[index:index + 1], 1, MPI.BOOL],
+                                                     source=0, tag=0))
+            self.__requests_send.append([])
         self.__logger.debug(f"sender communicators: {self.__comm_sender}")
         # TODO error handling
 
@@ -69,59 +127,132 @@ class TVBMpiWrapper:
         self.__logger.info(f"connected to {interscalehub_address}")
         return comm
 
-    def __send_mpi(self, comm, times, data):
+    def __send_mpi(self, times, rates):
         """
-        send mpi data
-        :param comm: MPI communicator
+        send mpi data to the transformers of all the proxies
+        framed protocol: the messages of all the proxies are in flight together
+        not framed protocol: the proxies are served one after the other, as the hub expects
         :param times: times of values
-        :param data: rates inputs
-        :param logger: logger of the modules
+        :param rates: rates inputs, (steps, proxies, ...)
         :return:nothing
         """
         self.__logger.info("start send")
+        if not self.__is_framed:
+            for index, comm in enumerate(self.__comm_sender):
+                self.__send_three_messages(comm, index, times, rates[:, index])
+            self.__logger.info("end send")
+            return
+        if self.__is_pipelined:
+            # the previous messages are delivered before their placeholders are reused
+            for index in range(len(self.__comm_sender)):
+                self.__wait_send(index)
+        frames = [self.__fill_frame(index, times, rates[:, index]) for index in range(len(self.__comm_sender))]
+        if self.__is_pipelined:
+            # the accept of the transformer and the message are in flight together,
+            # the transformer receives the message after its accept (the accepting rank is 0)
+            for index, (comm, frame) in enumerate(zip(self.__comm_sender, frames)):
+                self.__requests_accept[index].Start()
+                self.__requests_send[index] = [self.__requests_accept[index],
+                                               comm.Isend([frame, MPI.DOUBLE], dest=0, tag=0)]
+            self.__logger.info("send posted")
+            return
+        # wait until the transformers accept the connections
+        statuses = [MPI.Status() for _ in self.__comm_sender]
+        MPI.Prequest.Startall(self.__requests_accept)
+        MPI.Request.Waitall(self.__requests_accept, statuses)
+        self.__logger.info("send accept")
+        # the id of the excepted source
+        MPI.Request.Waitall([comm.Isend([frame, MPI.DOUBLE], dest=status_.Get_source(), tag=0)
+                             for comm, frame, status_ in zip(self.__comm_sender, frames, statuses)])
+        self.__logger.info("end send")
+
+    def __send_three_messages(self, comm, index, times, rates):
+        """
+        send the times, the size and the rates of a proxy in three messages (not framed protocol)
+        :param comm: MPI communicator
+        :param index: index of the proxy, selects the placeholder of the message
+        :param times: times of values
+        :param rates: rates of the proxy
+        """
         status_ = MPI.Status()
         # wait until the transformer accept the connections
         accept = False
         while not accept:
             req = comm.irecv(source=0, tag=0)
             accept = req.wait(status_)
-            self.__logger.info("send accept")
+        self.__logger.info("send accept")
         source = status_.Get_source()  # the id of the excepted source
-        self.__logger.info("get source")
-        data = np.ascontiguousarray(data, dtype='d')  # format the rate for sending
-        shape = np.array(data.shape[0], dtype='i')  # size of data
-        times = np.array(times, dtype='d')  # time of starting and ending step
-        comm.Send([times, MPI.DOUBLE], dest=source, tag=0)
-        comm.Send([shape, MPI.INT], dest=source, tag=0)
-        comm.Send([data, MPI.DOUBLE], dest=source, tag=0)
-        self.__logger.info("end send")
+        frame = self.__fill_frame(index, times, rates)
+        comm.Send([frame[:2], MPI.DOUBLE], dest=source, tag=0)
+        comm.Send([np.array(frame.shape[0] - 2, dtype='i'), MPI.INT], dest=source, tag=0)
+        comm.Send([frame[2:], MPI.DOUBLE], dest=source, tag=0)
 
-    def __mpi_receive(self, comm):
-        """ 
-            receive proxy values the
+    def __receive_three_messages(self, comm, index):
+        """
+        receive the times, the size and the rates of a proxy in three messages (not framed protocol)
         :param comm: MPI communicator
-        :param logger: logger of the modules
-        :return: rate of all proxy
+        :param index: index of the proxy
+        :return: times and rates of the proxy (valid until the next receive of the proxy),
+                 None at the end of the communication
         """
-        self.__logger.info("start receive")
         status_ = MPI.Status()
         # send to the transformer : I want the next part
         req = comm.isend(True, dest=0, tag=0)
         req.wait()
-        time_step = np.empty(2, dtype='d')
-        comm.Recv([time_step, 2, MPI.DOUBLE], source=0, tag=MPI.ANY_TAG, status=status_)
+        # the times and the rates are received in the placeholder of the proxy: [start_time, end_time, rates...]
+        comm.Recv([self.__receive_frames[index][:2], MPI.DOUBLE], source=0, tag=MPI.ANY_TAG, status=status_)
         # get the size of the rate
-        size = np.empty(1, dtype='i')
-        comm.Recv([size, MPI.INT], source=0, tag=0)
+        comm.Recv([self.__receive_size, MPI.INT], source=0, tag=0)
+        size = int(self.__receive_size[0])
+        if self.__receive_frames[index].shape[0] < size + 2:
+            frame = np.empty(size + 2, dtype='d')
+            frame[:2] = self.__receive_frames[index][:2]
+            self.__receive_frames[index] = frame
+        frame = self.__receive_frames[index][:size + 2]
         # get the rate
-        rates = np.empty(size, dtype='d')
-        comm.Recv([rates, size, MPI.DOUBLE], source=0, tag=MPI.ANY_TAG, status=status_)
-        self.__logger.info("end receive " + str(time_step))
-        # print the summary of the data
-        if status_.Get_tag() == 0:
-            return time_step, rates
-        else:
+        comm.Recv([frame[2:], MPI.DOUBLE], source=0, tag=MPI.ANY_TAG, status=status_)
+        if status_.Get_tag() != 0:
             return None
+        return frame[:2], frame[2:]
+
+    def __fill_frame(self, index, times, rates):
+        """
+        copy the message of a proxy in its placeholder
+        :param index: index of the proxy, selects the placeholder of the message
+        :param times: times of values
+        :param rates: rates of the proxy
+        :return: the message: [start_time, end_time, rates...]
+        """
+        # times and rates in one message, the size of data is given by the message
+        if self.__send_frames[index].shape[0] < rates.size + 2:
+            self.__send_frames[index] = np.empty(rates.size + 2, dtype='d')
+        frame = self.__send_frames[index][:rates.size + 2]
+        frame[:2] = times  # time of starting and ending step
+        frame[2:].reshape(rates.shape)[...] = rates  # the rates of the proxy, flattened
+        frame[2:] *= 1e3  # the rates are scaled by 1e3 for the transformer
+        return frame
+
+    def __wait_send(self, index):
+        """
+        wait until the message in flight of the proxy is delivered (pipelined mode)
+        :param index: index of the proxy
+        """
+        if self.__requests_send[index]:
+            MPI.Request.Waitall(self.__requests_send[index])
+            self.__requests_send[index] = []
+
+    def __post_receive(self, comm, index):
+        """
+        ask the transformer for the next part and post its receive
+        NOTE: the message is received in the placeholder of the proxy, the previous part must be consumed
+        :param comm: MPI communicator
+        :param index: index of the proxy, selects the placeholder of the message
+        """
+        self.__requests_next_part[index].Start()
+        # the size of the message is known: [start_time, end_time] and one rate by time step
+        self.__requests_receive[index] = [
+            self.__requests_next_part[index],
+            comm.Irecv([self.__receive_frames[index], MPI.DOUBLE], source=0, tag=MPI.ANY_TAG)]
 
     def __end_mpi(self, comm, is_mode_sending):
         """
@@ -139,10 +270,13 @@ class TVBMpiWrapper:
             status_ = MPI.Status()
             # wait until the transformer accept the connections
             self.__logger.info("TVB send check")
-            accept = False
-            while not accept:
-                req = comm.irecv(source=0, tag=0)
-                accept = req.wait(status_)
+            if self.__is_framed:
+                comm.Recv([self.__check, 1, MPI.BOOL], source=0, tag=0, status=status_)
+            else:
+                accept = False
+                while not accept:
+                    req = comm.irecv(source=0, tag=0)
+                    accept = req.wait(status_)
             self.__logger.info("TVB send end simulation")
             source = status_.Get_source()  # the id of the excepted source
             times = np.array([0., 0.], dtype='d')  # time of starting and ending step
@@ -151,8 +285,11 @@ class TVBMpiWrapper:
         else:
             self.__logger.info("TVB close connection receive " + self.__intercalehub_nest_to_tvb)
             # send to the transformer : I want the next part
-            req = comm.isend(True, dest=0, tag=1)
-            req.wait()
+            if self.__is_framed:
+                comm.Send([self.__request, 1, MPI.BOOL], dest=0, tag=1)
+            else:
+                req = comm.isend(True, dest=0, tag=1)
+                req.wait()
             self.__close_connection(comm, self.__intercalehub_nest_to_tvb)
         # # closing the connection at this end
         # self.__logger.info("TVB disconnect communication")
@@ -173,52 +310,95 @@ class TVBMpiWrapper:
     def __prepare_and_send_initialization_date(self):
         # prepare initialization data
         self.__logger.info("send initialization of TVB: prepare data")
-        initialization_data = []
-        for i in np.arange(0, self.__time_synch_n, 1, dtype=np.int):
-            initialization_data.append(self.__simulator_tvb._loop_compute_node_coupling(i)[:, self.__id_proxy, :])
-        initialization_data = np.concatenate(initialization_data)
+        # NOTE: all the steps are computed at once from the history (cached for repeated runs)
+        initialization_data = initial_coupling(self.__simulator_tvb, self.__time_synch_n, self.__id_proxy)
         time_init = [0, self.__time_synch]
 
         # send initialization data
         self.__logger.info("send initialization of TVB: send data")
-        for index, comm in enumerate(self.__comm_sender):
-            self.__send_mpi(comm, time_init, initialization_data[:, index] * 1e3)
+        self.__send_mpi(time_init, initialization_data)
 
     def __receive_data(self):
         """
         helper function to receive data (spikes) from
         InterscaleHub_NEST_to_TVB using MPI
+        framed protocol: the receives of all the proxies are in flight together
+        not framed protocol: the proxies are received one after the other, as the hub expects
+        the rates are copied in the input of TVB
+        :return: times of the rates, None at the end of the communication
         """
-        data_value = []
         self.__logger.debug("start receiving data")
-        for comm in self.__comm_receiver:
-            receive = self.__mpi_receive(comm)
-            time_data = receive[0]
-            data_value.append(receive[1])
-        self.__logger.debug(f"time received: {time_data}, data received: {data_value}")
-        return data_value, time_data, receive  # spikes
+        if not self.__is_framed:
+            time_data = None
+            for index, comm in enumerate(self.__comm_receiver):
+                receive = self.__receive_three_messages(comm, index)
+                if receive is None:
+                    return None
+                time_data = self.__copy_rates(index, time_data, *receive)
+            self.__logger.debug(f"time received: {time_data}, data received: {self.__data_value}")
+            return time_data
+        requests = []
+        for index, comm in enumerate(self.__comm_receiver):
+            # the receives of the pipelined mode are posted in advance, except for the first part
+            if not self.__requests_receive[index]:
+                self.__post_receive(comm, index)
+            requests += self.__requests_receive[index]
+            self.__requests_receive[index] = []
+        # the status of the message of each proxy follows the one of its request of the next part
+        statuses = [MPI.Status() for _ in requests]
+        MPI.Request.Waitall(requests, statuses)
+        time_data = None
+        for index, status_ in enumerate(statuses[1::2]):
+            if status_.Get_tag() != 0:
+                return None
+            # one message: [start_time, end_time, rates...]
+            frame = self.__receive_frames[index][:status_.Get_count(MPI.DOUBLE)]
+            time_data = self.__copy_rates(index, time_data, frame[:2], frame[2:])
+        self.__logger.debug(f"time received: {time_data}, data received: {self.__data_value}")
+        return time_data
+
+    def __copy_rates(self, index, time_data, time_step, rates):
+        """
+        copy the rates of a proxy in the input of TVB
+        :param index: index of the proxy
+        :param time_data: times of the proxies already received (None for the first one)
+        :param time_step: times of the rates of the proxy
+        :param rates: rates of the proxy
+        :return: times of the rates
+        """
+        if time_data is None:
+            time_data = np.array(time_step, dtype='d')
+        elif not np.array_equal(time_data, time_step):
+            raise (Exception('Bad time of data ' + str(time_step) + " " + str(time_data)))
+        if rates.shape[0] != self.__data_value.shape[0]:
+            self.__logger.critical(f"Bad shape of data:{rates.shape[0]}, "
+                                   f"expected: {self.__data_value.shape[0]}")
+            raise (Exception('Bad shape of data ' + str(rates.shape[0]) + " " +
+                             str(self.__data_value.shape[0])))
+        self.__data_value[:, 0, index, 0] = rates
+        return time_data
 
-    def __format_and_reshape_simulation_data(self, data_value, time_data, receive):
+    def __format_and_reshape_simulation_data(self, time_data):
         """helper function to format and reshape simulation data"""
         data = np.empty((2,), dtype=object)
         nb_step = np.rint((time_data[1] - time_data[0]) / self.__dt)
         nb_step_0 = np.rint(time_data[0] / self.__dt) + 1  # start at the first time step not at 0.0
         time_data = np.arange(nb_step_0, nb_step_0 + nb_step, 1) * self.__dt
-        data_value = np.swapaxes(np.array(data_value), 0, 1)[:, :]
-        data_value = np.expand_dims(data_value, axis=(1, 3))
         # check time and data shapes
-        if data_value.shape[0] != time_data.shape[0]:
+        if self.__data_value.shape[0] != time_data.shape[0]:
             self.__logger.critical(nb_step)
-            self.__logger.critical(self.__dt, time_data, receive)
-            self.__logger.critical(f"Bad shape of data:{data_value.shape[0]}, time shape: {time_data.shape[0]}")
+            self.__logger.critical(f"Bad shape of data:{self.__data_value.shape[0]}, "
+                                   f"time shape: {time_data.shape[0]}")
             # TODO handle exception
-            raise (Exception('Bad shape of data ' + str(data_value.shape[0]) + " " + str(time_data.shape[0])))
-        
+            raise (Exception('Bad shape of data ' + str(self.__data_value.shape[0]) + " " +
+                             str(time_data.shape[0])))
+
         # all is fine
-        self.__logger.debug(f"after formatting, time:{time_data}, data:{data_value}")
-        data[:] = [time_data, data_value]
+        self.__logger.debug(f"after formatting, time:{time_data}, data:{self.__data_value}")
+        # NOTE: the data is copied in the history of TVB before the next receive
+        data[:] = [time_data, self.__data_value]
         return data
-    
+
     def __run_tvb_simulation(self, data):
         """helper function to run TVB simulation with updated data"""
         self.__logger.info("TVB start simulation "
@@ -228,7 +408,10 @@ class TVBMpiWrapper:
             for i in range(self.__nb_monitor):
                 if result[i] is not None:
                     # save results of current simulation run
-                    self.__simulation_results[i].append(result[i])
+                    self.__simulation_results[i].append(*result[i])
+        # write the results of the step to disk (only with a path)
+        for store in self.__simulation_results:
+            store.flush()
         self.__logger.info(" TVB end simulation")
     
     def __send_data(self):
@@ -238,13 +421,17 @@ class TVBMpiWrapper:
         # get TVB output (rates) for NEST
         data_for_nest = self.__simulator_tvb.loop_cosim_monitor_output(n_steps=self.__time_synch_n)[0]
         times = [data_for_nest[0][0], data_for_nest[0][-1]]
-        rate = np.concatenate(data_for_nest[1][:, 0, [self.__id_proxy], 0])
-        for index, comm in enumerate(self.__comm_sender):
-            self.__send_mpi(comm, times, rate[:, index] * 1e3)
+        # the rates of the proxies: (steps, proxies)
+        self.__send_mpi(times, data_for_nest[1][:, 0, self.__id_proxy, 0])
         self.__logger.debug("data is send")
 
     def __finalize(self):
         """helper function to end communications and finalize MPI"""
+        # the last messages in flight are delivered before the end of the communications
+        for index in range(len(self.__comm_sender)):
+            self.__wait_send(index)
+        for request in self.__requests_accept + self.__requests_next_part:
+            request.Free()
         # close ports and send signal to end communications by
         # Inter-communicator for sending MPI data
         for index, comm in enumerate(self.__comm_sender):
@@ -262,13 +449,20 @@ class TVBMpiWrapper:
 
     def __reshape_result(self, result):
         """reshapes the output of TVB for the"""
-        times = []
-        values = []
-        for (running_time, running_value) in result[0]:
-            if running_time > 0.0:
-                times.append(running_time)
-                values.append(running_value)
-        return ([np.array(times), np.expand_dims(np.concatenate(values), 1)],)
+        if self.__result_writers:
+            # the results are on disk: memory-mapped, only the parts used are read
+            for writer in self.__result_writers:
+                writer.close()
+            times, values = read_monitor_results(self.__results_prefixes[0])
+        else:
+            times, values = result[0].times, result[0].values
+        # the samples after the time 0.0, the times are increasing: views, no copy
+        first = np.searchsorted(times, 0.0, side='right')
+        times = times[first:]
+        values = values[first:]
+        # the values of the samples one after the other along the first axis
+        values = values.reshape((-1,) + values.shape[2:])
+        return ([times, np.expand_dims(values, 1)],)
     
     def run_simulation_and_data_exchange(self, global_minimum_step_size):
         """
@@ -285,9 +479,15 @@ class TVBMpiWrapper:
         # while self.__simulation_run_counter * self.__time_synch < self.__simulation_length:
         while self.__simulation_run_counter * global_minimum_step_size < self.__simulation_length:
             # 1. receive data from InterscaleHub_NEST_to_TVB
-            data_value, time_data, receive = self.__receive_data()
+            time_data = self.__receive_data()
             # 2. format time and data for input to TVB simulation
-            data = self.__format_and_reshape_simulation_data(data_value, time_data, receive)
+            data = self.__format_and_reshape_simulation_data(time_data)
+            # 2.1 pipelined mode: the data is copied, ask for the next part before integrating,
+            # the transformer can send it as soon as it is ready (only if there is a next step)
+            if self.__is_pipelined and \
+                    (self.__simulation_run_counter + 1) * global_minimum_step_size < self.__simulation_length:
+                for index, comm in enumerate(self.__comm_receiver):
+                    self.__post_receive(comm, index)
             # 3. run TVB simulation until next synchronization time check with
             # data received from NEST
             self.__run_tvb_simulation(data)
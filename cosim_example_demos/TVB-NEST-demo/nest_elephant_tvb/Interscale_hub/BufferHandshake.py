@@ -0,0 +1,134 @@
+# ------------------------------------------------------------------------------
+#  Copyright 2020 Forschungszentrum Jülich GmbH
+# "Licensed to the Apache Software Foundation (ASF) under one or more contributor
+#  license agreements; and to You under the Apache License, Version 2.0. "
+#
+# Forschungszentrum Jülich
+#  Institute: Institute for Advanced Simulation (IAS)
+#    Section: Jülich Supercomputing Centre (JSC)
+#   Division: High Performance Computing in Neuroscience
+# Laboratory: Simulation Laboratory Neuroscience
+#       Team: Multi-scale Simulation and Design
+#
+# ------------------------------------------------------------------------------
+
+from collections import deque
+from mpi4py import MPI
+import numpy as np
+
+
+class BufferHandshake:
+    '''
+    Synchronization of the shared memory buffer between the rank which fills it
+    (writer) and the rank which consumes it (reader).
+
+    Replaces the polling of the status flag of the buffer (sleep of 1 ms).
+    The ranks notify each other with small messages on the INTRA communicator,
+    so a rank waiting for the buffer wakes up as soon as the other one is done.
+
+    The buffer is a ring of slots, filled and consumed in the same order.
+    The writer only waits when all the slots are full, i.e. with more than one
+    slot, the reception of the next step overlaps the processing of the current one.
+    MPI messages with the same source and tag are not overtaking, so the
+    notifications are matched slot by slot.
+
+    Writer: wait_free -> fill the slot -> notify_ready (-> send_spill)
+    Reader: wait_ready (-> receive_spill) -> consume the slot -> notify_free
+
+    Data which does not fit in the slot is spilled: it is sent to the reader
+    by message after the notification of the slot.
+    '''
+    # tags of the notifications, distinct from the tags used by the simulators
+    READY = 100
+    FREE = 101
+    SPILL = 102
+
+    def __init__(self, intracomm, writer, reader, nb_slots=1):
+        '''
+        :param intracomm: the INTRA communicator of the InterscaleHub
+        :param writer: rank which fills the buffer
+        :param reader: rank which consumes the buffer
+        :param nb_slots: number of slots of the buffer
+        '''
+        self.__comm = intracomm
+        self.__writer = writer
+        self.__reader = reader
+        self.__nb_slots = nb_slots
+        self.__notification = np.ones(1, dtype='b')
+        # one placeholder by slot, for the pending receives of 'free'
+        self.__free_notification = np.empty(nb_slots, dtype='b')
+        # all the slots are free at the beginning
+        self.__requests_free = deque()
+        self.__writer_slot = 0
+        self.__reader_slot = 0
+        # placeholder of the spilled data on the reader, grows on demand
+        self.__spill = np.empty(0, dtype='d')
+
+    @property
+    def writer_slot(self):
+        '''slot to fill by the writer'''
+        return self.__writer_slot
+
+    @property
+    def reader_slot(self):
+        '''slot to consume by the reader'''
+        return self.__reader_slot
+
+    def wait_free(self):
+        '''
+        Writer: block until the slot to fill is consumed by the reader.
+        '''
+        if len(self.__requests_free) == self.__nb_slots:
+            self.__requests_free.popleft().Wait()
+
+    def notify_ready(self):
+        '''
+        Writer: the data is in the slot, wake up the reader and move to the next slot.
+        '''
+        # post the receive of the 'free' before notifying, the reader can answer immediately
+        self.__requests_free.append(
+            self.__comm.Irecv([self.__free_notification[self.__writer_slot:], 1, MPI.BOOL],
+                              source=self.__reader, tag=self.FREE))
+        self.__comm.Send([self.__notification, 1, MPI.BOOL], dest=self.__reader, tag=self.READY)
+        self.__writer_slot = (self.__writer_slot + 1) % self.__nb_slots
+
+    def send_spill(self, data):
+        '''
+        Writer: send the data which did not fit in the slot just notified.
+        :param data: array of doubles
+        '''
+        self.__comm.Send([data, MPI.DOUBLE], dest=self.__reader, tag=self.SPILL)
+
+    def receive_spill(self, size):
+        '''
+        Reader: receive the data which did not fit in the slot to consume.
+        :param size: number of doubles spilled by the writer
+        :return: the spilled data (valid until the next call)
+        '''
+        if self.__spill.shape[0] < size:
+            self.__spill = np.empty(max(size, 2 * self.__spill.shape[0]), dtype='d')
+        self.__comm.Recv([self.__spill[:size], MPI.DOUBLE], source=self.__writer, tag=self.SPILL)
+        return self.__spill[:size]
+
+    def wait_ready(self):
+        '''
+        Reader: block until the writer has filled the slot to consume.
+        '''
+        self.__comm.Recv([self.__notification, 1, MPI.BOOL], source=self.__writer, tag=self.READY)
+
+    def notify_free(self):
+        '''
+        Reader: the data is consumed, wake up the writer and move to the next slot.
+        '''
+        self.__comm.Send([self.__notification, 1, MPI.BOOL], dest=self.__writer, tag=self.FREE)
+        self.__reader_slot = (self.__reader_slot + 1) % self.__nb_slots
+
+    def close(self):
+        '''
+        Writer: cancel the pending receives, e.g. the last data was never consumed.
+        '''
+        while self.__requests_free:
+            request = self.__requests_free.popleft()
+            if not request.Test():
+                request.Cancel()
+                request.Wait()
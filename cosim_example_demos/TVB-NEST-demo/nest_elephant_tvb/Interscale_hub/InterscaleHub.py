@@ -22,6 +22,7 @@ import time
 from Interscale_hub.parameter import Parameter
 import Interscale_hub.pivot as piv
 import Interscale_hub.IntercommManager as icm
+from Interscale_hub.transformer import compact_slot_size
 
 
 class InterscaleHub:
@@ -43,6 +44,7 @@ class InterscaleHub:
         - How many MPI ranks on the sending simulation (M ranks)
         - How many MPI ranks on the InterscaleHub (N ranks)
         -> This contains: parallel buffer access, transformation, analysis and sending
+        -> DONE: the transformation is shared by all ranks except the receiving one
     - M:N:O mapping -> How many MPI ranks on the receiving simulation (O ranks)
     - multiple transformers, second pivot?
     
@@ -118,13 +120,13 @@ class InterscaleHub:
         if self.__direction == 1:
                 if self.__comm.Get_rank() == 0:
                     self.__ic.close_and_finalize(self.__input_comm, self.__input_port)
-                else:
+                elif self.__comm.Get_rank() == 1:
                     self.__ic.close_and_finalize(self.__output_comm, self.__output_port)
 
         elif self.__direction == 2:
                 if self.__comm.Get_rank() == 0:
                     self.__ic.close_and_finalize(self.__output_comm, self.__output_port)
-                else:
+                elif self.__comm.Get_rank() == 1:
                     self.__ic.close_and_finalize(self.__input_comm, self.__input_port)
 
         
@@ -135,9 +137,13 @@ class InterscaleHub:
         '''
         Create shared memory buffer. MPI One-sided-Communication.
         MVP: datasize ist MPI.Double, buffersize is set with param init
+        
+        The buffer is a ring of nb_slots slots of buffersize doubles, one row by slot.
+        With more than one slot, the receiving rank fills the next slot
+        while the previous one is transformed and sent.
         '''
         if self.__comm.Get_rank() == 0:
-            bufbytes = self.__datasize * self.__buffersize
+            bufbytes = self.__datasize * self.__buffersize * self.__nb_slots
         else: 
             bufbytes= 0
         # rank 0: create the shared block
@@ -149,7 +155,7 @@ class InterscaleHub:
         # TODO: add error handling and fail checks
         assert self.__datasize == MPI.DOUBLE.Get_size()
         # create a 1D numpy array (buffer) whose data points to the shared mem
-        self.__databuffer = np.ndarray(buffer=buf, dtype='d', shape=(self.__buffersize,))
+        self.__databuffer = np.ndarray(buffer=buf, dtype='d', shape=(self.__nb_slots, self.__buffersize))
         
     
     def _data_channel_setup(self, direction):
@@ -162,23 +168,22 @@ class InterscaleHub:
             - input = incoming simulation data
             - output = outgoing simulation data
         '''
+        # NOTE: rank 2-x only share the transformation, they are not connected
+        self.__input_comm = None
+        self.__output_comm = None
         # NEST-to-TVB
         if self.__direction == 1:
                 if self.__comm.Get_rank() == 0:
                     self.__input_comm, self.__input_port = self.__ic.open_port_accept_connection(self.__input_path)
-                    self.__output_comm = None
-                else:
+                elif self.__comm.Get_rank() == 1:
                     self.__output_comm, self.__output_port = self.__ic.open_port_accept_connection(self.__output_path)
-                    self.__input_comm = None
 
         # TVB-to-NEST
         elif self.__direction == 2:
                 if self.__comm.Get_rank() == 0:
                     self.__output_comm, self.__output_port = self.__ic.open_port_accept_connection(self.__output_path)
-                    self.__input_comm = None
-                else:
+                elif self.__comm.Get_rank() == 1:
                     self.__input_comm, self.__input_port = self.__ic.open_port_accept_connection(self.__input_path)
-                    self.__output_comm = None
     
     def get_ids_of_nodes_to_be_connected(self, path, direction):
         
@@ -251,8 +256,6 @@ class InterscaleHub:
         self.__ic = icm.IntercommManager(self.__comm, self.__root)
         
         # Buffer
-        # TODO: needs to be a global cosim setting. more information needed!
-        max_events = 1000000 # max. expected number of events per step
         self.__datasize = MPI.DOUBLE.Get_size()
         
         # USECASE parameter
@@ -260,12 +263,20 @@ class InterscaleHub:
         # align this with the rest of the implementation and below param init
         self.__direction = direction
         self.__param = p.get_param(direction)
+        # number of slots of the buffer (ring), 2: double buffering
+        self.__nb_slots = int(self.__param['nb_buffer_slots'])
         path = self.__param['path']
         id_transformer = 0
         id_proxy = self.__param['id_nest_region']
         # nest to tvb
         if self.__direction == 1:
-            self.__buffersize = max_events * 3 # 3 doubles per event
+            max_events = self._max_events() # max. expected number of events per step
+            self.__logger.info("buffer size: " + str(max_events) + " events by slot")
+            if self.__param.get('compact_spikes'):
+                # 6 bytes per event, 3 doubles: [first time step, number of events, spilled size]
+                self.__buffersize = compact_slot_size(max_events)
+            else:
+                self.__buffersize = max_events * 3 + 2 # 3 doubles per event, 2 doubles: [head, spilled size]
             # NOTE input and output are connected to the same port
             # self.__input_path = p.get_nest_to_tvb_port()
             # self.__output_path = p.get_nest_to_tvb_port()
@@ -283,7 +294,10 @@ class InterscaleHub:
 
         # tvb to nest
         elif self.__direction == 2:
-            self.__buffersize = 2 + max_events # 2 doubles: [start_time,end_time] of simulation step
+            # 2 doubles: [start_time,end_time] of simulation step, one rate by integration step
+            # and 2 doubles: [size of the rate, unused]
+            nb_rates = int(np.ceil(self.__param['time_synchronization'] / self.__param['resolution']))
+            self.__buffersize = 2 + nb_rates + 2
             # self.__buffersize = (2, 2)
             # self.percentage_shared = self.__param['percentage_shared']  # percentage of shared rate between neurons
             # self.nb_spike_generator = self.__param['nb_spike_generator']         # number of spike generator
@@ -333,6 +347,23 @@ class InterscaleHub:
     
     
     
+    def _max_events(self):
+        '''
+        Maximum expected number of spike events from NEST per step.
+        
+        Taken from the parameter 'max_events' if it is given, otherwise
+        estimated from the network: neurons x expected rate x time of synchronization x safety factor.
+        The packages which exceed it are spilled to the transforming rank (see pivot).
+        
+        :return: number of events of a slot of the buffer
+        '''
+        if self.__param.get('max_events'):
+            return int(self.__param['max_events'])
+        expected_events = (self.__param['nb_neurons'][0] * self.__param['expected_rate']  # Hz
+                           * self.__param['time_synchronization'] * 1e-3)  # ms
+        return max(1, int(np.ceil(expected_events * self.__param['buffer_safety_factor'])))
+    
+    
     def _temp_protocol_translation():
         '''
         TODO: temporary translation of protocol behaviour
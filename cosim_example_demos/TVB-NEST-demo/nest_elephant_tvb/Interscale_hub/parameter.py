@@ -20,10 +20,11 @@ class Parameter:
     Hardcoded, without any error and safety handling.
     NOTE: 
     List of hardcoded parameter in the InterscaleHub (to be completed)
-    - max_events set in InterscaleHub.py
     - min_delay set in Simulation_mock.py
     - simulation params (ids, size) set in Simulation_mock.py
     - tvb to nest params (size_list, list_id) set in pivot.py
+    - the parameters of the transformation (transformers of the registry, seed, ...) are only set here,
+      parameters/scientific/interscale_hub.xml configures the EBRAINS_InterscaleHUB of the action adapters
 
     '''
     def __init__(self):
@@ -40,13 +41,37 @@ class Parameter:
                 "nb_neurons": [100],
                 # parameter for the synchronization between simulators
                 "time_synchronization": 1.2,
+                # number of slots of the shared buffer of the InterscaleHub (2: double buffering)
+                "nb_buffer_slots": 2,
+                # size of the shared buffer: max. number of events from NEST per step,
+                # 0: neurons x expected_rate (Hz) x time_synchronization x buffer_safety_factor
+                "max_events": 0,
+                "expected_rate": 100.0,
+                "buffer_safety_factor": 10.0,
+                # events of the shared buffer as neuron ids (int32) and time steps (uint16) instead of
+                # 3 doubles (id of device not kept, spike times rounded to the resolution)
+                # NOTE: the packages of NEST are still received as doubles, in a private stage of rank 0
+                # sized for the events of the step (not for the slot), and encoded as they arrive
+                "compact_spikes": False,
                 "id_nest_region": [0],
                 # parameter for the transformation of data between scale
                 "nb_brain_synapses": 1,
+                # percentage of shared rate between the spike generators (transformers sip and mip)
+                "percentage_shared": 0.5,
+                # seed of the random generators of the transformation
+                # one stream by hub, step and block of nb_generators_by_stream spike generators
+                "seed": 125,
+                "nb_generators_by_stream": 100,
                 'id_first_neurons': [1],
+                # ids of the spike detectors with their own histogram (store_data), None: one for all
+                "id_spike_detectors": None,
                 "save_spikes": True,
                 "save_rate": True,
                 "width": 20.0,
+                # transformers of the registry (transformer.py): numpy (fast) or elephant (reference, for validation),
+                # correlated spike trains from TVB to NEST: sip or mip (Kuhn et al. 2003)
+                "transformer_nest_to_tvb": "numpy",
+                "transformer_tvb_to_nest": "numpy",
                 "id_first_spike_detector": 229
         }
         # path to files containing the MPI port info
@@ -13,15 +13,17 @@
 # ------------------------------------------------------------------------------ 
 # 
 from mpi4py import MPI
-import time
 import numpy as np
 import logging
 import sys
 
 #nest to tvb
-from Interscale_hub.transformer import store_data, analyse_data, spiketorate
+from Interscale_hub.transformer import store_data, analyse_data, spike_events
+from Interscale_hub.transformer import compact_views, append_compact_spike_events
 #tvb to nest
-from Interscale_hub.transformer import generate_data
+from Interscale_hub.transformer import select_spike_trains
+from Interscale_hub.transformer import create_transformer
+from Interscale_hub.BufferHandshake import BufferHandshake
 
 
 # NestTvbPivot and TvbNestPivot classes:
@@ -35,6 +37,17 @@ from Interscale_hub.transformer import generate_data
 
 # TODO: rework on the receive and send loops (both, general coding style and usecase specifics)
 
+def partition(nb_items, part, nb_parts):
+    '''
+    Contiguous and balanced partition of items (events, spike generators) between ranks.
+    :param nb_items: number of items
+    :param part: index of the part, i.e. rank in the communicator of the transformation
+    :param nb_parts: number of parts
+    :return first, last: range [first, last) of the items of the part
+    '''
+    return nb_items * part // nb_parts, nb_items * (part + 1) // nb_parts
+
+
 class NestTvbPivot:
     def __init__(self, intracomm, param, comm_receiver, comm_sender, databuffer):
         '''
@@ -54,12 +67,27 @@ class NestTvbPivot:
         if intracomm.Get_rank() == 0:
             self.__comm_receiver = comm_receiver
             self.__num_sending = self.__comm_receiver.Get_remote_size()
-        else:
+        elif intracomm.Get_rank() == 1:
             self.__comm_sender = comm_sender
             self.__num_receiving = self.__comm_sender.Get_remote_size()
 
         # How many Nest ranks are sending, how many Tvb ranks are receiving
+        # ring of buffers: one row by slot
         self.__databuffer = databuffer
+        # the events of the slots are compact (see transformer.compact_views) or the raw doubles of NEST
+        self.__compact = bool(param.get('compact_spikes', False))
+        # rank 0 fills the buffer, rank 1 transforms and sends its content
+        self.__handshake = BufferHandshake(intracomm, writer=0, reader=1, nb_slots=databuffer.shape[0])
+        # ranks 1-x share the transformation, rank 1 is the root
+        self.__transform_comm = intracomm.Split(MPI.UNDEFINED if intracomm.Get_rank() == 0 else 0,
+                                                intracomm.Get_rank())
+        # placeholders of the transformation, reused at each step
+        self.__command = np.empty(3, dtype=np.int64) # [count, slot, 1: transform or 0: stop]
+        self.__rate = np.empty(0, dtype='d') # sum of the partial rates
+        # the rate of a step depends on the previous steps: one transformer for the whole simulation
+        self.__spikerate = None
+        if intracomm.Get_rank() != 0:
+            self.__spikerate = create_transformer('spike_to_rate', param.get('transformer_nest_to_tvb', 'numpy'), param)
     
     
     def start(self, intracomm):
@@ -67,12 +95,14 @@ class NestTvbPivot:
         Start the pivot operation.
         M:N mapping of MPI ranks, receive data, further process data.
         
-        MVP: receive on rank 0, do the rest on rank 1.
+        MVP: receive on rank 0, send on rank 1, transform on rank 1-x.
         '''
         if intracomm.Get_rank() == 0: # Receiver from input sim, rank 0
             self._receive()
-        else: #  Science/analyse and sender to TVB, rank 1-x
+        elif intracomm.Get_rank() == 1: #  Science/analyse and sender to TVB, rank 1
             self._send()
+        else: # Science/analyse, rank 2-x
+            self._transform_worker()
 
 
     def stop(self):
@@ -89,62 +119,129 @@ class NestTvbPivot:
         NOTE: First refactored version -> not pretty, not final. 
         '''
         # The last two buffer entries are used for shared information
-        # --> they replace the status_data variable from previous version
-        # --> find more elegant solution?
+        # --> the state of the buffer is exchanged with the handshake
         self.__logger.info("setting up buffers")
-        self.__databuffer[-1] = 1 # set buffer to 'ready to receive from nest'
-        self.__databuffer[-2] = 0 # marks the 'head' of the buffer
+        self.__databuffer[:, -2] = 0 # marks the 'head' of each slot of the buffer
+        self.__databuffer[:, -1] = 0 # number of doubles which did not fit in the slot
+        capacity = self.__databuffer.shape[1] - 2
+        if self.__compact:
+            # the packages are received in a private stage, sized for the packages of the step
+            # (not for the slot), and each package is encoded into the slot as soon as it arrives:
+            # the reception of a step does not wait for a free slot
+            self.__databuffer[:, -3] = 0 # first time step of the events of the slot
+            neurons, steps = compact_views(self.__databuffer[0])
+            capacity = 3 * neurons.shape[0]
+        # stage of the compact mode, grows on demand
+        stage = np.empty(0, dtype='d')
+        # placeholder for the packets which do not fit in the slot, grows on demand
+        spill = np.empty(0, dtype='d')
         # It seems the 'check' variable is used to receive tags from NEST, i.e. ready for send...
         # change this in the future, also mentioned in the FatEndPoint solution from Wouter.
-        check = np.empty(1,dtype='b')
-        shape = np.empty(1, dtype='i')    
+        # One entry by NEST rank: all the ranks are handled at the same time
+        check = np.empty(self.__num_sending, dtype='b')
+        ready = np.ones(self.__num_sending, dtype='b')
+        shape = np.empty(self.__num_sending, dtype='i')
+        offsets = np.empty(self.__num_sending, dtype=np.int64) # reserved offset of each package
+        statuses = [MPI.Status() for i in range(self.__num_sending)]
+        # the messages of fixed size are the same at each step: persistent requests
+        # NOTE: one receive by source, a fast rank can not be matched twice in the same step
+        requests_check = [self.__comm_receiver.Recv_init([check[i:i + 1], 1, MPI.CXX_BOOL], source=i, tag=MPI.ANY_TAG)
+                          for i in range(self.__num_sending)]
+        requests_size = [self.__comm_receiver.Recv_init([shape[i:i + 1], 1, MPI.INT], source=i, tag=0)
+                         for i in range(self.__num_sending)]
+        requests_ready = [self.__comm_receiver.Send_init([ready[i:i + 1], 1, MPI.BOOL], dest=i, tag=0)
+                          for i in range(self.__num_sending)]
         count = 0
-        status_ = MPI.Status()
         self.__logger.info("reading from buffer")
         # self.__logger.info("NESTtoTVB -- consumer/receiver -- Rank:"+str(self.__comm_receiver.Get_rank()))
         while True:
             head_ = 0 # head of the buffer, reset after each iteration            
-            # TODO: This is still not correct. We only check for the Tag of the last rank.
-            # IF all ranks send always the same tag in one iteration (simulation step)
-            # then this works. But it should be handled differently!!!!
-            self.__comm_receiver.Recv([check, 1, MPI.CXX_BOOL], source=0, tag=MPI.ANY_TAG, status=status_)
-            
-            status_rank_0 = status_.Get_tag()
-            for i in range(1, self.__num_sending):
-                # new: We do not care which source sends first, give MPI the freedom to send in whichever order.
-                # self.__comm_receiver.Recv([check, 1, MPI.CXX_BOOL], source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status_)
-                # self.__logger.info("checking status")
-                self.__comm_receiver.Recv([check, 1, MPI.CXX_BOOL], source=i, tag=MPI.ANY_TAG, status=status_)
-                if status_rank_0 != status_.Get_tag():
-                    raise Exception('Abnormal state : the state of Nest is different between rank')
+            spill_ = 0 # head of the spilled data, reset after each iteration
+            # receive the state of all the NEST ranks, in whichever order they send it
+            MPI.Prequest.Startall(requests_check)
+            MPI.Request.Waitall(requests_check, statuses)
+            tag = statuses[0].Get_tag()
+            if any(status.Get_tag() != tag for status in statuses):
+                raise Exception('Abnormal state : the state of Nest is different between rank')
 
-            if status_.Get_tag() == 0:
-                # wait until ready to receive new data (i.e. the sender has cleared the buffer)
-                while self.__databuffer[-1] != 1: # TODO: use MPI, remove the sleep
-                    time.sleep(0.001)
-                    pass
-                for source in range(self.__num_sending):
-                    # send 'ready' to the nest rank
-                    # self.__logger.info("send ready")
-                    self.__comm_receiver.Send([np.array(True,dtype='b'),MPI.BOOL],dest=source,tag=0)
-                    # receive package size info
-                    # self.__logger.info("DEBUG 121 ====> receiving size in NEST_TVB_PIVOT")
-                    self.__comm_receiver.Recv([shape, 1, MPI.INT], source=source, tag=0, status=status_)
-                    # self.__comm_receiver.Recv([shape, 1, MPI.INT], source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status_)
-                    # NEW: receive directly into the buffer
-                    self.__comm_receiver.Recv([self.__databuffer[head_:], MPI.DOUBLE], source=source, tag=0, status=status_)
-                    head_ += shape[0] # move head 
+            if tag == 0:
+                if not self.__compact:
+                    # wait until ready to receive new data (i.e. the sender has cleared the buffer)
+                    self.__handshake.wait_free()
+                    target = self.__databuffer[self.__handshake.writer_slot]
+                # receive the package sizes, then send 'ready' to all the nest ranks
+                MPI.Prequest.Startall(requests_size)
+                MPI.Prequest.Startall(requests_ready)
+                requests = list(requests_ready)
+                # reserve the place of each package as soon as its size arrives
+                # and receive it directly into the buffer
+                spilled = []
+                staged = []
+                for i in range(self.__num_sending):
+                    source = MPI.Request.Waitany(requests_size)
+                    if head_ + shape[source] <= capacity:
+                        offsets[source] = head_
+                        if self.__compact:
+                            # received when all the sizes are known, the stage is sized for the step
+                            staged.append(source)
+                        else:
+                            requests.append(self.__comm_receiver.Irecv(
+                                [target[head_:head_ + shape[source]], MPI.DOUBLE], source=source, tag=0))
+                        head_ += shape[source] # move head
+                    else:
+                        # overflow of the slot: keep the package aside instead of overrunning the buffer
+                        offsets[source] = spill_
+                        spilled.append(source)
+                        spill_ += shape[source]
+                if spill_ > 0:
+                    # all the sizes are known: no pending receive into the spill while it grows
+                    if spill.shape[0] < spill_:
+                        spill = np.empty(2 * spill_, dtype='d')
+                    for source in spilled:
+                        requests.append(self.__comm_receiver.Irecv(
+                            [spill[offsets[source]:offsets[source] + shape[source]], MPI.DOUBLE], source=source, tag=0))
+                if self.__compact:
+                    if stage.shape[0] < head_:
+                        stage = np.empty(head_, dtype='d')
+                    requests_staged = [self.__comm_receiver.Irecv(
+                        [stage[offsets[source]:offsets[source] + shape[source]], MPI.DOUBLE], source=source, tag=0)
+                        for source in staged]
+                    self.__handshake.wait_free()
+                    databuffer = self.__databuffer[self.__handshake.writer_slot]
+                    neurons, steps = compact_views(databuffer)
+                    # encode the packages in the order of arrival, the others are still in flight
+                    nb_events, first_step, last_step = 0, 0, 0
+                    for i in range(len(staged)):
+                        source = staged[MPI.Request.Waitany(requests_staged)]
+                        events = spike_events(stage[offsets[source]:], shape[source])
+                        first_step, last_step = append_compact_spike_events(
+                            events, self.__param['resolution'], neurons, steps, nb_events, first_step, last_step)
+                        nb_events += events.shape[0]
+                    databuffer[-3] = first_step
+                    # number of events of the slot
+                    databuffer[-2] = nb_events
+                MPI.Request.Waitall(requests)
+                if not self.__compact:
+                    databuffer = target
+                    # important: head_ is first buffer index WITHOUT data.
+                    databuffer[-2] = head_
+                databuffer[-1] = spill_
                 # Mark as 'ready to do analysis'
-                self.__databuffer[-1] = 0
-                # important: head_ is first buffer index WITHOUT data.
-                self.__databuffer[-2] = head_
-            elif status_.Get_tag() == 1:
+                self.__handshake.notify_ready()
+                if spill_ > 0:
+                    self.__logger.warning("buffer overflow: " + str(spill_ // 3) + " events spilled, "
+                                          "increase the buffer size (max_events or buffer_safety_factor)")
+                    self.__handshake.send_spill(spill[:spill_])
+            elif tag == 1:
                 count += 1
-            elif status_.Get_tag() == 2:
+            elif tag == 2:
                 # NOTE: simulation ended
+                self.__handshake.close()
                 break
             else:
-                raise Exception("bad mpi tag"+str(status_.Get_tag()))
+                raise Exception("bad mpi tag"+str(tag))
+        for request in requests_check + requests_size + requests_ready:
+            request.Free()
     
     
     def _send(self):
@@ -155,41 +252,43 @@ class NestTvbPivot:
         '''
         count=0 # simulation/iteration step
         status_ = MPI.Status()
+        check = np.empty(1, dtype='b')
+        # one message by step: [start_time, end_time, rates...], grows on demand
+        frame = np.empty(2, dtype='d')
+        # the request of TVB is the same at each step: persistent request
+        request_check = self.__comm_sender.Recv_init([check, 1, MPI.BOOL], source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG)
         # self.__logger.info("NESTtoTVB -- producer/sender -- Rank:"+str(self.__comm_sender.Get_rank()))
         while True:
             # TODO: this communication has the 'rank 0' problem described in the beginning
-            accept = False
             #logger.info("Nest to TVB : wait to send " )
-            while not accept:
-                req = self.__comm_sender.irecv(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG)
-                accept = req.wait(status_)
+            request_check.Start()
+            request_check.Wait(status_)
             #logger.info(" Nest to TVB : send data status : " +str(status_.Get_tag()))
             if status_.Get_tag() == 0:
-                # wait until the receiver has cleared the buffer, i.e. filled with new data
-                while self.__databuffer[-1] != 0: # TODO: use MPI, remove the sleep
-                    time.sleep(0.001)
-                    pass
+                # wait until the receiver has filled the buffer with new data
+                self.__handshake.wait_ready()
                 # TODO: All science/analysis here. Move to a proper place.
                 times,data = self._transform(count)
                 # Mark as 'ready to receive next simulation step'
-                self.__databuffer[-1] = 1
+                self.__handshake.notify_free()
                 
-                ### OLD Code
                 #logger.info("Nest to TVB : send data :"+str(np.sum(data)) )
-                # time of sim step
-                self.__comm_sender.Send([times, MPI.DOUBLE], dest=status_.Get_source(), tag=0)
-                # send the size of the rate
-                size = np.array(int(data.shape[0]),dtype='i')
-                self.__comm_sender.Send([size,MPI.INT], dest=status_.Get_source(), tag=0)
-                # send the rates
-                self.__comm_sender.Send([data,MPI.DOUBLE], dest=status_.Get_source(), tag=0)
-                ### OLD Code end
+                # time of sim step and rates in one message, the size is given by the message
+                if frame.shape[0] < data.shape[0] + 2:
+                    frame = np.empty(data.shape[0] + 2, dtype='d')
+                frame[:2] = times
+                frame[2:data.shape[0] + 2] = data
+                self.__comm_sender.Send([frame[:data.shape[0] + 2], MPI.DOUBLE], dest=status_.Get_source(), tag=0)
             elif status_.Get_tag() == 1:
                 # NOTE: simulation ended
+                # stop the other ranks of the transformation
+                self.__transform_comm.Bcast([np.zeros(3, dtype=np.int64), MPI.INT64_T], root=0)
                 break
             else:
                 raise Exception("bad mpi tag"+str(status_.Get_tag()))
             count+=1
+        request_check.Free()
+        self.__spikerate.finalize()
 
     
     def _transform(self, count):
@@ -201,8 +300,22 @@ class NestTvbPivot:
         '''
         #store: Python object, create the histogram 
         #analyse: Python object, calculate rates
-        spikerate = spiketorate(self.__param)
-        times, data = spikerate.spike_to_rate(count, self.__databuffer[-2], self.__databuffer)
+        slot = self.__handshake.reader_slot
+        databuffer = self.__databuffer[slot]
+        spikerate = self.__spikerate
+        # share the events of the slot with the other ranks of the transformation
+        self.__command[:] = (count, slot, 1)
+        self.__transform_comm.Bcast([self.__command, MPI.INT64_T], root=0)
+        partial_rate = self._partial_rate(count, databuffer)
+        if databuffer[-1] > 0:
+            # overflow of the slot: the spilled events are only on this rank
+            spill = self.__handshake.receive_spill(int(databuffer[-1]))
+            partial_rate += spikerate.partial_rate(count, spike_events(spill, spill.shape[0]))
+        # sum of the partial rates of all the ranks
+        if self.__rate.shape[0] != partial_rate.shape[0]:
+            self.__rate = np.empty_like(partial_rate)
+        self.__transform_comm.Reduce([partial_rate, MPI.DOUBLE], [self.__rate, MPI.DOUBLE], op=MPI.SUM, root=0)
+        times, data = spikerate.times(count), spikerate.rate(self.__rate)
 
         '''
         store = store_data(self.__param)
@@ -212,14 +325,50 @@ class NestTvbPivot:
         # Make this parallel with the INTRA communicator (should be embarrassingly parallel).
         # Step 1) take all data from buffer and create histogram
         # second to last index in databuffer denotes how much data there is
-        self.__logger.info("NESTtoTVBPivot -- transform -- buffer head:"+str(self.__databuffer[-2]))
-        store.add_spikes(count, self.__databuffer[:int(self.__databuffer[-2])])
+        self.__logger.info("NESTtoTVBPivot -- transform -- buffer head:"+str(databuffer[-2]))
+        store.add_spikes(count, databuffer[:int(databuffer[-2])])
         # Step 2) take the resulting histogram
         data_to_analyse = store.return_data()
         # Step 3) Analyse this data, i.e. calculate rates?
         times,data = analyse.analyse(count, data_to_analyse)
         '''
         return times, data
+
+
+    def _partial_rate(self, count, databuffer):
+        '''
+        Partial rate of the part of the events of the slot of this rank.
+        :param count: Simulation iteration/step
+        :param databuffer: the slot of the buffer to transform
+        :return: the partial rate (see transformer.spiketorate.partial_rate)
+        '''
+        rank, size = self.__transform_comm.Get_rank(), self.__transform_comm.Get_size()
+        if self.__compact:
+            neurons, steps = compact_views(databuffer)
+            first, last = partition(int(databuffer[-2]), rank, size)
+            return self.__spikerate.partial_rate_compact(count, neurons[first:last], steps[first:last],
+                                                         int(databuffer[-3]))
+        events = spike_events(databuffer, databuffer[-2])
+        first, last = partition(events.shape[0], rank, size)
+        return self.__spikerate.partial_rate(count, events[first:last])
+
+
+    def _transform_worker(self):
+        '''
+        Share the transformation of rank 1 (rank 2-x).
+        Each rank transforms a contiguous part of the events of the slot,
+        the partial rates are summed on rank 1.
+        '''
+        spikerate = self.__spikerate
+        command = self.__command
+        while True:
+            self.__transform_comm.Bcast([command, MPI.INT64_T], root=0)
+            if command[2] == 0:
+                break
+            count, slot = command[0], command[1]
+            partial_rate = self._partial_rate(count, self.__databuffer[slot])
+            self.__transform_comm.Reduce([partial_rate, MPI.DOUBLE], None, op=MPI.SUM, root=0)
+        spikerate.finalize()
     
 
 
@@ -243,11 +392,23 @@ class TvbNestPivot:
         if intracomm.Get_rank() == 1:
             self.__comm_receiver = comm_receiver
             self.__num_sending = self.__comm_receiver.Get_remote_size()
-        else:    
+        elif intracomm.Get_rank() == 0:
             self.__comm_sender = comm_sender
             self.__num_receiving = self.__comm_sender.Get_remote_size()
         # How many TVB ranks are sending, how many NEST ranks are receiving
+        # ring of buffers: one row by slot
         self.__databuffer = databuffer
+        # rank 1 fills the buffer, rank 0 transforms and sends its content
+        self.__handshake = BufferHandshake(intracomm, writer=1, reader=0, nb_slots=databuffer.shape[0])
+        # ranks 0 and 2-x share the transformation, rank 0 is the root
+        self.__transform_comm = intracomm.Split(MPI.UNDEFINED if intracomm.Get_rank() == 1 else 0,
+                                                intracomm.Get_rank())
+        # placeholder of the command of the transformation, reused at each step
+        self.__command = np.empty(3, dtype=np.int64) # [count, slot, 1: transform or 0: stop]
+        # one transformer for the whole simulation
+        self.__generator = None
+        if intracomm.Get_rank() != 1:
+            self.__generator = create_transformer('rate_to_spike', param.get('transformer_tvb_to_nest', 'numpy'), param)
 
 
     def start(self, intracomm):
@@ -255,12 +416,14 @@ class TvbNestPivot:
         Start the pivot operation.
         M:N mapping of MPI ranks, receive data, further process data.
         
-        MVP: receive on rank 0, do the rest on rank 1.
+        MVP: receive on rank 1, send on rank 0, transform on rank 0 and 2-x.
         '''
-        if intracomm.Get_rank() == 0: # Receiver from input sim, rank 0
+        if intracomm.Get_rank() == 0: # Science/generate and sender to NEST, rank 0
             self._send()
-        else: #  Science/analyse and sender to TVB, rank 1-x
+        elif intracomm.Get_rank() == 1: # Receiver from input sim, rank 1
             self._receive()
+        else: # Science/generate, rank 2-x
+            self._transform_worker()
 
 
     def stop(self):
@@ -276,44 +439,47 @@ class TvbNestPivot:
         Replaces the former 'receive' function.
         NOTE: First refactored version -> not pretty, not final. 
         '''
-        # The last two buffer entries are used for shared information
-        # --> they replace the status_data variable from previous version
-        # --> find more elegant solution?
-        self.__databuffer[-1] = 1 # set buffer to 'ready to receive from tvb'
-        self.__databuffer[-2] = 0 # marks the 'head' of the buffer
-        # init placeholder for incoming data
-        size = np.empty(1, dtype='i') # size of the rate-array
+        # The second to last buffer entry is used for shared information
+        # --> the state of the buffer is exchanged with the handshake
+        self.__databuffer[:, -2] = 0 # marks the 'head' of each slot of the buffer
+        ready = np.ones(self.__num_sending, dtype='b')
+        end = np.empty(2, dtype='d') # placeholder of the message of the end of the simulation
         status_ = MPI.Status()
+        # the 'ready' is the same at each step: persistent requests
+        requests_ready = [self.__comm_receiver.Send_init([ready[rank:rank + 1], 1, MPI.BOOL], dest=rank, tag=0)
+                          for rank in range(self.__num_sending)]
         # self.__logger.info("TVBtoNEST -- consumer/receiver -- Rank:"+str(self.__comm_receiver.Get_rank()))
         while True:
             # NOTE: Check communication protocol between simulators and transformers!
-            requests=[]
-            for rank in range(self.__num_sending):
-                requests.append(self.__comm_receiver.isend(True,dest=rank,tag=0))
-            MPI.Request.Waitall(requests)
+            MPI.Prequest.Startall(requests_ready)
+            MPI.Request.Waitall(requests_ready)
             # NOTE: works for now, needs rework if multiple ranks are used on TVB side
-            # we receive from "ANY_SOURCE", but only check the status_ of the last receive...
-            # get the starting and ending time of the simulation step
-            # NEW: receive directly into the buffer
-            self.__comm_receiver.Recv([self.__databuffer[0:], MPI.DOUBLE], source=0, tag=MPI.ANY_TAG, status=status_)
+            # one message by step: [start_time, end_time, rates...]
+            # probe it first: the previous step may not be consumed yet
+            message = self.__comm_receiver.Mprobe(source=0, tag=MPI.ANY_TAG, status=status_)
             if status_.Get_tag() == 0:
+                size = status_.Get_count(MPI.DOUBLE) - 2 # size of the rate-array
+                if size > self.__databuffer.shape[1] - 4:
+                    raise Exception("buffer overflow: " + str(size) + " rates for a buffer of "
+                                    + str(self.__databuffer.shape[1] - 4))
                 # wait until ready to receive new data (i.e. the sender has cleared the buffer)
-                while self.__databuffer[-1] != 1: # TODO: use MPI, remove the sleep
-                    time.sleep(0.001)
-                    pass
-                # Get the size of the data
-                self.__comm_receiver.Recv([size, 1, MPI.INT], source=status_.Get_source(), tag=0, status=status_)
+                self.__handshake.wait_free()
+                databuffer = self.__databuffer[self.__handshake.writer_slot]
                 # NEW: receive directly into the buffer
-                # First two entries are the times, see above
-                self.__comm_receiver.Recv([self.__databuffer[2:], MPI.DOUBLE], source=status_.Get_source(), tag=0, status=status_)
+                # First two entries are the times
+                message.Recv([databuffer[:size + 2], MPI.DOUBLE])
+                databuffer[-2] = size # info about size of data array
                 # Mark as 'ready to do analysis'
-                self.__databuffer[-1] = 0
-                self.__databuffer[-2] = size # info about size of data array
+                self.__handshake.notify_ready()
             elif status_.Get_tag() == 1:
                 # NOTE: simulation ended
+                message.Recv([end, MPI.DOUBLE])
+                self.__handshake.close()
                 break
             else:
                 raise Exception("bad mpi tag"+str(status_.Get_tag()))
+        for request in requests_ready:
+            request.Free()
         
         # logger.info('TVB_to_NEST: End of receive function')
 
@@ -326,25 +492,33 @@ class TvbNestPivot:
         '''
         status_ = MPI.Status()
         # NOTE: hardcoded...
-        check = np.empty(1,dtype='b')
-        size_list = np.empty(1, dtype='i')
+        check = np.empty(self.__num_receiving, dtype='b')
+        size_list = np.empty(self.__num_receiving, dtype='i')
+        statuses = [MPI.Status() for rank in range(self.__num_receiving)]
+        # the messages of fixed size are the same at each step: persistent requests
+        requests_check = [self.__comm_sender.Recv_init([check[rank:rank + 1], 1, MPI.CXX_BOOL], source=rank, tag=MPI.ANY_TAG)
+                          for rank in range(self.__num_receiving)]
+        requests_size = [self.__comm_sender.Recv_init([size_list[rank:rank + 1], 1, MPI.INT], source=rank, tag=0)
+                         for rank in range(self.__num_receiving)]
         id_first_spike_detector = self.__param['id_first_spike_detector']
+        count = 0 # simulation/iteration step
         while True:
-            # TODO: This is still not correct. We only check for the Tag of the last rank.
-            # IF all ranks send always the same tag in one iteration (simulation step)
-            # then this works. But it should be handled differently!!!!
-            for rank in range(self.__num_receiving):
-                self.__comm_sender.Recv([check, 1, MPI.CXX_BOOL], source=rank, tag=MPI.ANY_TAG, status=status_)
-            if status_.Get_tag() == 0:
-                # wait until the receiver has cleared the buffer, i.e. filled with new data
-                while self.__databuffer[-1] != 0: # TODO: use MPI, remove the sleep
-                    time.sleep(0.001)
-                    pass
+            # receive the state of all the NEST ranks, in whichever order they send it
+            MPI.Prequest.Startall(requests_check)
+            MPI.Request.Waitall(requests_check, statuses)
+            tag = statuses[0].Get_tag()
+            if any(status.Get_tag() != tag for status in statuses):
+                raise Exception('Abnormal state : the state of Nest is different between rank')
+
+            if tag == 0:
+                # wait until the receiver has filled the buffer with new data
+                self.__handshake.wait_ready()
 
                 # TODO: All science/generate here. Move to a proper place.
-                spikes_times = self._transform()
+                spikes_times, offsets = self._transform(count)
+                count += 1
                 # Mark as 'ready to receive next simulation step'
-                self.__databuffer[-1] = 1
+                self.__handshake.notify_free()
                 
                 ### OLD code, kept the communication and science as it is for now
                 # NOTE: Receive from status_.Get_source() and rank
@@ -353,53 +527,117 @@ class TvbNestPivot:
                 # a second status_ object is used, should not be named the same
                 for rank in range(self.__num_receiving):
                     # NOTE: hardcoded 10 in simulation mocks
-                    self.__comm_sender.Recv([size_list, 1, MPI.INT], source=rank, tag=0, status=status_)
-                    if size_list[0] != 0:
-                        list_id = np.empty(size_list, dtype='i')
+                    requests_size[rank].Start()
+                    requests_size[rank].Wait(status_)
+                    if size_list[rank] != 0:
+                        list_id = np.empty(size_list[rank], dtype='i')
                         # NOTE: hardcoded np.arange(0,10,1) in simulation mocks
-                        self.__comm_sender.Recv([list_id, size_list, MPI.INT], source=status_.Get_source(), tag=0, status=status_)
-                        # Select the good spike train and send it
-                        # TODO: create lists, append to lists, nested loops
-                        # this is slow and will be a bottleneck when we scale up.
-                        data = []
-                        shape = []
-                        for i in list_id:
-                            shape += [spikes_times[i-id_first_spike_detector].shape[0]]
-                            data += [spikes_times[i-id_first_spike_detector]]
-                        send_shape = np.array(np.concatenate(([np.sum(shape)],shape)), dtype='i')
+                        self.__comm_sender.Recv([list_id, size_list[rank], MPI.INT], source=status_.Get_source(), tag=0, status=status_)
+                        # Select the good spike trains and send them
+                        shape, data = select_spike_trains(spikes_times, offsets, list_id - id_first_spike_detector)
+                        send_shape = np.empty(shape.shape[0] + 1, dtype='i')
+                        send_shape[0] = data.shape[0]
+                        send_shape[1:] = shape
                         # firstly send the size of the spikes train
                         # self.__logger.info("sending size of train")
                         self.__comm_sender.Send([send_shape, MPI.INT], dest=status_.Get_source(), tag=list_id[0])
                         # secondly send the spikes train
-                        data = np.concatenate(data).astype('d')
                         # self.__logger.info("sending train")
                         self.__comm_sender.Send([data, MPI.DOUBLE], dest=rank, tag=list_id[0])
                 ### OLD code end
-            elif  status_.Get_tag() == 1:
+            elif tag == 1:
                 # NOTE: one sim step? inconsistent with receiving side
                 continue
-            elif status_.Get_tag() == 2:
+            elif tag == 2:
                 # NOTE: simulation ended
+                # stop the other ranks of the transformation
+                self.__transform_comm.Bcast([np.zeros(3, dtype=np.int64), MPI.INT64_T], root=0)
                 break
             else:
-                raise Exception("bad mpi tag : "+str(status_.Get_tag()))
+                raise Exception("bad mpi tag : "+str(tag))
+        for request in requests_check + requests_size:
+            request.Free()
+        self.__generator.finalize()
         
 
-    def _transform(self):
+    def _transform(self, count):
         '''
         This step contains some pivoting, transformation and analysis.
         TODO: encapsulate
+        :param count: Simulation iteration/step, selects the random stream of the step
+        :return spikes_times, offsets: spike times of all generators and offsets of each generator
+        '''
+        slot = self.__handshake.reader_slot
+        # share the spike generators with the other ranks of the transformation
+        self.__command[:] = (count, slot, 1)
+        self.__transform_comm.Bcast([self.__command, MPI.INT64_T], root=0)
+        return self._generate_part(self.__generator, count, self.__databuffer[slot])
+
+
+    def _transform_worker(self):
+        '''
+        Share the transformation of rank 0 (rank 2-x).
+        Each rank generates the spike trains of a contiguous part of the spike generators,
+        the spike trains are gathered on rank 0.
+        '''
+        command = self.__command
+        while True:
+            self.__transform_comm.Bcast([command, MPI.INT64_T], root=0)
+            if command[2] == 0:
+                break
+            self._generate_part(self.__generator, command[0], self.__databuffer[command[1]])
+        self.__generator.finalize()
+
+
+    def _generators_of_part(self, part, nb_parts):
+        '''
+        Partition of the spike generators between the ranks, by whole blocks of random stream
+        (see transformer.generate_data): the spike trains do not depend on the number of ranks.
+        :param part: rank in the communicator of the transformation
+        :param nb_parts: number of ranks of the transformation
+        :return first, last: range [first, last) of the spike generators of the part
+        '''
+        nb_generators = self.__param['nb_neurons'][0]
+        size = int(self.__param['nb_generators_by_stream'])
+        first, last = partition(-(-nb_generators // size), part, nb_parts)
+        return min(first * size, nb_generators), min(last * size, nb_generators)
+
+    def _generate_part(self, generator, count, databuffer):
+        '''
+        Generate the spike trains of the part of this rank and gather them on the root.
+        :param generator: the transformer
+        :param count: Simulation iteration/step
+        :param databuffer: the slot of the buffer to transform
+        :return spikes_times, offsets: on the root, spike times of all generators and offsets of each generator
         '''
-        generator = generate_data(self.__param)
-        # NOTE: count is a hardcoded '0'. Why?
+        comm = self.__transform_comm
+        nb_generators = self.__param['nb_neurons'][0]
+        first, last = self._generators_of_part(comm.Get_rank(), comm.Get_size())
         # time_step are the first two doubles in the buffer
         # rate is a double array, which size is stored in the second to last index
-        if int(self.__databuffer[-2]) == 0:
-            spikes_times = generator.generate_spike(0,
-                                                self.__databuffer[:2],
-                                                self.__databuffer[2:])
+        # NOTE: the last two doubles of the slot are not data
+        if int(databuffer[-2]) == 0:
+            spikes_times, offsets = generator.transform(count,
+                                                databuffer[:2],
+                                                databuffer[2:-2], first, last)
         else:
-            spikes_times = generator.generate_spike(0,
-                                                self.__databuffer[:2],
-                                                self.__databuffer[2:int(self.__databuffer[-2])])
-        return spikes_times
+            spikes_times, offsets = generator.transform(count,
+                                                databuffer[:2],
+                                                databuffer[2:2 + int(databuffer[-2])], first, last)
+        if comm.Get_size() == 1:
+            return spikes_times, offsets
+        # gather the number of spikes of each rank, then the trains (CSR layout)
+        is_root = comm.Get_rank() == 0
+        nb_spikes = np.empty(comm.Get_size(), dtype=np.int64) if is_root else None
+        comm.Gather([np.array([spikes_times.shape[0]], dtype=np.int64), MPI.INT64_T], [nb_spikes, MPI.INT64_T], root=0)
+        nb_trains = np.diff([self._generators_of_part(rank, comm.Get_size())[0] for rank in range(comm.Get_size() + 1)])
+        all_offsets = np.zeros(nb_generators + 1, dtype=np.int64) if is_root else None
+        all_spikes = np.empty(np.sum(nb_spikes), dtype='d') if is_root else None
+        comm.Gatherv([np.diff(offsets), MPI.INT64_T],
+                     [all_offsets[1:], nb_trains, MPI.INT64_T] if is_root else None, root=0)
+        comm.Gatherv([spikes_times, MPI.DOUBLE],
+                     [all_spikes, nb_spikes, MPI.DOUBLE] if is_root else None, root=0)
+        if is_root:
+            np.cumsum(all_offsets, out=all_offsets)
+            return all_spikes, all_offsets
+        return None, None
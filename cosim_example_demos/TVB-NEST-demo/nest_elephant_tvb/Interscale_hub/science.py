@@ -17,90 +17,123 @@
 # implement properly as elephant science part
 # use both methods as Elephant plugin example!
 
-from elephant.spike_train_generation import homogeneous_poisson_process, inhomogeneous_poisson_process
-from elephant.statistics import mean_firing_rate
 import numpy as np
-from neo import AnalogSignal
-from quantities import Hz
 
-def rates_to_spikes( rates, t_start, t_stop, variation=False):
+# the times are in ms and the rates in Hz: rate (Hz) x duration (ms) / MS_PER_SECOND = number of spikes
+MS_PER_SECOND = 1e3
+
+
+def _magnitude(value, unit):
+    """
+    plain float of a value of quantities (boundary of the science functions)
+    :param value: float, array or quantities
+    :param unit: unit of the result, e.g. 'ms' or 'Hz'
+    :return: the value in the unit, without quantities
+    """
+    if hasattr(value, 'rescale'):
+        return np.asarray(value.rescale(unit).magnitude, dtype=np.float64)
+    return np.asarray(value, dtype=np.float64)
+
+
+def inhomogeneous_poisson_trains(rng, rate, t_start, sampling_period, nb_trains):
+    """
+    generate independent spike trains with piecewise constant rates in one pass
+    the number of spikes of each train in each sample is drawn from a Poisson
+    distribution and the spikes are uniformly distributed inside the sample
+    :param rng: numpy random generator
+    :param rate: rate of each sample in Hz, the same for all the trains (1-D)
+                 or one row by train (2-D: nb_trains x nb_samples)
+    :param t_start: beginning of the first sample in ms
+    :param sampling_period: duration of one sample in ms
+    :param nb_trains: number of spike trains
+    :return: spike times of all the trains (ordered by train and by time) and
+             offsets of the trains (train i is times[offsets[i]:offsets[i+1]])
     """
-    Generate spike train with homogenous or inhomogenous Poisson generator
-    :param rates: an array or a float of quantities
-    :param t_start: time to start spike train
-    :param t_stop: time where the spike train stop
+    nb_samples = rate.shape[-1]
+    counts = rng.poisson(rate * (sampling_period / MS_PER_SECOND), size=(nb_trains, nb_samples))
+    offsets = np.zeros(nb_trains + 1, dtype=np.int64)
+    np.cumsum(counts.sum(axis=1), out=offsets[1:])
+    samples = np.repeat(np.tile(np.arange(nb_samples), nb_trains), counts.ravel())
+    times = t_start + (samples + rng.random(samples.shape[0])) * sampling_period
+    # the trains are already contiguous, only the spikes inside a sample need to be sorted
+    trains = np.repeat(np.arange(nb_trains), np.diff(offsets))
+    return times[np.lexsort((times, trains))], offsets
+
+
+def rates_to_spikes(rates, t_start, t_stop, variation=False, rng=None):
+    """
+    Generate spike trains with homogenous or inhomogenous Poisson generator, all the trains in one call
+    :param rates: rates in Hz (float, array or quantities)
+                  without variation: one rate (0-D) or one rate by train (1-D)
+                  with variation: the rate of each sample of one train (1-D) or one row by train (2-D)
+    :param t_start: time to start spike train in ms (float or quantities)
+    :param t_stop: time where the spike train stop in ms (float or quantities)
     :param variation: Boolean for variation of rate
-    :return: one or multiple spike train
+    :param rng: numpy random generator (default: a new one)
+    :return: spike times in ms of all the trains (ordered by train and by time) and
+             offsets of the trains (train i is spikes[offsets[i]:offsets[i+1]])
     """
+    if rng is None:
+        rng = np.random.default_rng()
+    rates = _magnitude(rates, 'Hz')
+    t_start = float(_magnitude(t_start, 'ms'))
+    t_stop = float(_magnitude(t_stop, 'ms'))
     if variation:
         # the case where the variation of the rate is include
-        # We generate the inhomogenous poisson
-        if len(rates.shape) == 1:
-            # the case where we have only one rate
-            signal = AnalogSignal(rates, t_start=t_start, sampling_period=(t_stop-t_start)/rates.shape[-1])
-            result = [inhomogeneous_poisson_process(signal,as_array=True)]
-            return np.array(result)
-        else :
-            # the case where we have multiple rates
-            result = []
-            for rate in rates:
-                signal = AnalogSignal(rate, t_start=t_start, sampling_period=(t_stop - t_start) / rates.shape[-1])
-                result.append(inhomogeneous_poisson_process(signal,as_array=True))
-            return np.array(result)
+        # We generate the inhomogenous poisson, one row of samples by train
+        rates = np.atleast_2d(rates)
     else:
         # the case we have only the rate
-        # We generate the homogenous poisson
-        if len(rates.shape) ==0:
-            # the case where we have only one rate
-            result = np.array([homogeneous_poisson_process(rate=rates, t_start=t_start, t_stop=t_stop, as_array=True)])
-        else:
-            # the case where we have multiple rates
-            result = []
-            for rate in rates:
-                result.append(homogeneous_poisson_process(rate=rate, t_start=t_start, t_stop=t_stop, as_array=True))
-        return np.array(result)
+        # We generate the homogenous poisson: one sample for the whole interval by train
+        rates = np.reshape(rates, (-1, 1))
+    return inhomogeneous_poisson_trains(rng, rates, t_start, (t_stop - t_start) / rates.shape[-1], rates.shape[0])
 
-def spikes_to_rate( spikes,t_start,t_stop, windows=0.0):
-    """
-    #WARNING function unused but keep it for idea
-    Compute the rate of one spike train or multiple of spike trains
 
-    #TODO : need to have add the overlapping of windows
-    :param spikes: one spike train or multiple spike train
-    :param t_start: time to start to compute rate
-    :param t_stop: time to stop to compute rate
-    :param windows: the window for compute rate
-    # :param overlaps: FUTURE overlap of window
-    :return: rates or variation of rates
+def spikes_to_rate(spikes, offsets, t_start, t_stop, windows=0.0, step=None):
     """
-
-    if windows == 0.0:
+    Compute the rate of one spike train or multiple of spike trains, all the trains and windows in one call
+    The spikes are counted in the half-open intervals [start, stop[.
+    :param spikes: spike times in ms of all the trains, ordered by train (float, array or quantities)
+    :param offsets: offsets of the trains (train i is spikes[offsets[i]:offsets[i+1]]), None: one train
+    :param t_start: time to start to compute rate in ms (float or quantities)
+    :param t_stop: time to stop to compute rate in ms (float or quantities)
+    :param windows: the window for compute rate in ms, 0.0: one window [t_start, t_stop[
+    :param step: time between the beginning of two windows in ms (default: windows, no overlap)
+                 smaller than windows: overlapping windows
+    :return: rates in Hz: one by train without windows,
+             one row by window (the windows which end before t_stop) and one column by train with windows
+    """
+    spikes = np.ravel(_magnitude(spikes, 'ms'))
+    if offsets is None:
+        offsets = np.array([0, spikes.shape[0]], dtype=np.int64)
+    t_start = float(_magnitude(t_start, 'ms'))
+    t_stop = float(_magnitude(t_stop, 'ms'))
+    windows = float(_magnitude(windows, 'ms'))
+    variation = windows != 0.0
+    if not variation:
         #case without variation of rate
-        if len(spikes[0].shape) ==0:
-            # with only one rate
-            result = [mean_firing_rate(spiketrain=spikes,t_start=t_start,t_stop=t_stop).rescale(Hz)]
-        else:
-            # with multiple rate
-            result = []
-            for spike in spikes:
-                result.append(mean_firing_rate(spiketrain=spike,t_start=t_start,t_stop=t_stop).rescale(Hz))
-        return np.array(result)
+        starts = np.array([t_start])
+        windows = t_stop - t_start
     else:
         # case with variation of rate
-        rate = []
-        for time in np.arange(t_start,t_stop,windows):
-            t_start_window = time*t_start.units
-            t_stop_window = t_start_window+windows
-            if len(spikes[0].shape) == 0:
-                # for only one spike train
-                result = [mean_firing_rate(spiketrain=spikes, t_start=t_start_window, t_stop=t_stop_window).rescale(Hz)]
-            else:
-                # for multiple spike train
-                result = []
-                for spike in spikes:
-                    result.append(mean_firing_rate(spiketrain=spike, t_start=t_start_window, t_stop=t_stop_window).rescale(Hz))
-            rate.append(result)
-        return np.array(rate)
+        step = windows if step is None else float(_magnitude(step, 'ms'))
+        if step <= 0.0:
+            raise Exception("the step between windows must be positive : " + str(step))
+        # the windows which end before t_stop (tolerance for the floating point error)
+        nb_windows = int(np.floor((t_stop - t_start - windows) / step + 1e-9)) + 1
+        starts = t_start + np.arange(max(nb_windows, 0)) * step
+    nb_trains = offsets.shape[0] - 1
+    # number of spikes of each train before each boundary: count(window) = before(stop) - before(start)
+    # the boundaries of the windows are shared by the overlapping windows: each spike is binned once
+    boundaries, index = np.unique(np.concatenate((starts, starts + windows)), return_inverse=True)
+    bins = np.searchsorted(boundaries, spikes, side='right')
+    trains = np.repeat(np.arange(nb_trains), np.diff(offsets))
+    hist = np.bincount(trains * (boundaries.shape[0] + 1) + bins,
+                       minlength=nb_trains * (boundaries.shape[0] + 1)).reshape(nb_trains, -1)
+    before = np.cumsum(hist, axis=1)[:, :boundaries.shape[0]]
+    counts = before[:, index[starts.shape[0]:]] - before[:, index[:starts.shape[0]]]
+    rates = counts.T * (MS_PER_SECOND / windows)
+    return rates if variation else rates[0]
 
 if __name__=='__main__':
     from quantities import ms,Hz
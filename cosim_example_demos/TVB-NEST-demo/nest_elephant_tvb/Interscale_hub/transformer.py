@@ -18,32 +18,89 @@
 #   - encapsulate this into transformer and science parts and make it suitable as plug-in
 
 import numpy as np
-import copy
 
 import logging
 import sys
 # science related imports
-from Interscale_hub.science import rates_to_spikes
+from Interscale_hub.science import inhomogeneous_poisson_trains, MS_PER_SECOND
 from elephant.spike_train_generation import inhomogeneous_poisson_process
 from quantities import ms,Hz
 from neo.core import SpikeTrain, AnalogSignal
 from elephant.statistics import instantaneous_rate
 from elephant.kernels import RectangularKernel
 
+############
+# Units of the InterscaleHub
+############
+# Inside the InterscaleHub, the times are in ms and the rates in Hz, as plain float64 arrays:
+# no quantities or neo objects in the steps (only the elephant references convert to them).
+# The units of the simulators are converted at the boundaries with these constants (and MS_PER_SECOND).
+RATE_DIVISOR_TVB = 10.0  # rate of the population in Hz / RATE_DIVISOR_TVB -> input of the model of TVB
+MIN_RATE = 1e-12  # Hz, the rate of a Poisson generator is never zero
+# ms, the sampling period of the rates is the resolution minus this margin:
+# the number of bins of a step, int(duration / sampling period), is not lost to the rounding of the times
+SAMPLING_PERIOD_MARGIN = 1e-6
+
+
+############
+# Plug-in interface of the transformers
+############
+class transformer:
+    """
+    interface of the transformers of the InterscaleHub (plug-in)
+    A transformer is created once by the pivot (init), called at each step of
+    synchronization (transform) and finalized at the end of the simulation (finalize).
+    The layouts of the data in and out of transform are declared by the class:
+    - 'events': (n,3) doubles from NEST, id of device, id of neuron, spike time
+    - 'rate': times [start, end] of the step and rate of each sample (TVB)
+    - 'spike_trains': spike times of all the trains and offsets of each train (CSR)
+    The transformers are selected by name from the registry, see create_transformer.
+    """
+    input_layout = None
+    output_layout = None
+
+    def __init__(self, param):
+        """
+        :param param: parameters of the InterscaleHub
+        """
+        pass
+
+    def transform(self, count, *data):
+        """
+        :param count: the number of step of synchronization between simulators
+        :param data: the data of the step, in the input layout
+        :return: the data of the step, in the output layout
+        """
+        raise NotImplementedError
+
+    def finalize(self):
+        """
+        end of the simulation
+        """
+        pass
+
+
 ############
 # Transformation and Science for NEST-TVB direction
 ############
 # TODO: proper transformation and science
-def slidding_window(data,width):
+def slidding_window(data,width,statistic=None):
     """
     use for mean field
     :param data: instantaneous firing rate
     :param width: windows or times average of the mean field
-    :return: state variable of the mean field
+    :param statistic: statistic of each window, e.g. np.max (default: the mean, computed by cumulative sum)
+    :return: state variable of the mean field, one value for each window starting at 0..len(data)-width-1
     """
-    res = np.zeros((data.shape[0]-width,width))
-    res [:,:] = np.squeeze(data[np.array([[ i+j for i in range(width) ] for j in range(data.shape[0]-width)])])
-    return res.mean(axis=1)
+    data = np.ravel(data)
+    nb_windows = data.shape[0] - width
+    if statistic is None:
+        # sum of data[j:j+width] = cumsum[j+width] - cumsum[j]
+        cumsum = np.zeros(data.shape[0] + 1)
+        np.cumsum(data, out=cumsum[1:])
+        return (cumsum[width:width + nb_windows] - cumsum[:nb_windows]) / width
+    # view of the windows, no copy of the data
+    return statistic(np.lib.stride_tricks.sliding_window_view(data, width)[:nb_windows], axis=1)
 
 class store_data:
     def __init__(self,param):
@@ -54,28 +111,49 @@ class store_data:
         """
         self.synch=param['time_synchronization']                # time of synchronization between 2 run
         self.dt=param['resolution']              # the resolution of the integrator
-        self.shape = (int(self.synch/self.dt),1) # the shape of the buffer/histogram
+        # ids of the devices with their own histogram (one column by device), None: one histogram for all
+        self.id_devices = param.get('id_spike_detectors')
+        nb_columns = 1 if self.id_devices is None else len(self.id_devices)
+        self.shape = (int(np.around(self.synch/self.dt)),nb_columns) # the shape of the buffer/histogram
         self.hist = np.zeros(self.shape)         # the initialisation of the histogram
+        self.nb_out_of_window = 0                # number of events ignored: out of the step or unknown device
         
     def add_spikes(self,count,datas):
         """
         adding spike in the histogram
         :param count: the number of synchronization times
-        :param datas: the spike :(id,time)
+        :param datas: the spike :(id of device, id of neuron, time), not modified
+        :return: number of events ignored because they are out of the step or from an unknown device
         """
-        for data in np.reshape(datas,(int(datas.shape[0]/3),3)):
-            data[2]-=self.dt
-            self.hist[int((data[2]-count*self.synch)/self.dt)]+=1
+        events = spike_events(datas, datas.shape[0])
+        # the spike at t is in the bin [t-dt, t[, rounded to ignore the error of the floating point
+        bins = np.floor(np.around((events[:, 2] - count*self.synch)/self.dt, decimals=6)).astype(np.int64) - 1
+        if self.id_devices is None:
+            columns = np.zeros(events.shape[0], dtype=np.int64)
+            known = np.ones(events.shape[0], dtype=bool)
+        else:
+            id_devices = np.asarray(self.id_devices)
+            order = np.argsort(id_devices)
+            position = np.minimum(np.searchsorted(id_devices, events[:, 0], sorter=order), id_devices.shape[0] - 1)
+            columns = order[position]
+            known = id_devices[columns] == events[:, 0]
+        valid = known & (bins >= 0) & (bins < self.shape[0])
+        # all the histograms in one pass
+        self.hist += np.bincount(bins[valid] * self.shape[1] + columns[valid],
+                                 minlength=self.shape[0] * self.shape[1]).reshape(self.shape)
+        nb_ignored = events.shape[0] - int(np.count_nonzero(valid))
+        self.nb_out_of_window += nb_ignored
         #self.logger.info(int(datas.shape[0]/3))
+        return nb_ignored
 
     def return_data(self):
         """
         return the histogram and reinitialise the histogram
         :return: histogram
         """
-        hist_copy = copy.copy(self.hist)
+        hist = self.hist
         self.hist = np.zeros(self.shape) # initialise histogram histogram of one region
-        return hist_copy
+        return hist
 
 class analyse_data:
     def __init__(self,param):
@@ -104,14 +182,218 @@ class analyse_data:
         return times,data*self.coeff
 
 
-class spiketorate:
+def spike_events(buffer_of_spikes, size_buffer):
+    """
+    view the raw NEST data of the shared buffer as events
+    :param buffer_of_spikes: buffer contains id of devices, id of neurons and spike times
+    :param size_buffer: size of the data in the buffer
+    :return: (n,3) view (no copy) of the buffer: id of device, id of neuron, spike time
+    """
+    return np.reshape(buffer_of_spikes[:int(np.rint(size_buffer))], (-1, 3))
+
+
+############
+# Compact events (optional layout of the shared buffer)
+############
+# The events of a slot are stored as neuron ids (int32) and time steps (uint16), relative to
+# the first step of the slot: 6 bytes by event instead of 3 doubles. The id of the device is not kept.
+# The end of the slot is a header of COMPACT_HEADER doubles: [first step, number of events, number of spilled doubles]
+COMPACT_HEADER = 3
+COMPACT_EVENT_BYTES = 6
+
+
+def compact_slot_size(max_events):
+    """
+    :param max_events: number of events of a slot
+    :return: size of a slot in doubles, with its header
+    """
+    return -(-max_events * COMPACT_EVENT_BYTES // 8) + COMPACT_HEADER
+
+
+def compact_views(databuffer):
+    """
+    view the compact events of a slot (no copy)
+    :param databuffer: the slot, doubles
+    :return: neuron ids (int32) and time steps (uint16) of all the places of the slot
+    """
+    capacity = (databuffer.shape[0] - COMPACT_HEADER) * 8 // COMPACT_EVENT_BYTES
+    raw = databuffer[:-COMPACT_HEADER].view(np.uint8)
+    # one array by field: the transformations which only need the times read 2 bytes by event
+    return raw[:4 * capacity].view(np.int32), raw[4 * capacity:6 * capacity].view(np.uint16)
+
+
+def compact_spike_events(events, resolution, neurons, steps):
+    """
+    encode the events from NEST (conversion at the boundary of the InterscaleHub)
+    NOTE: the spike times are rounded to the resolution (exact for the spikes on the grid of NEST)
+    :param events: (n,3) events: id of device, id of neuron, spike time in ms
+    :param resolution: duration of a time step in ms
+    :param neurons: placeholder of the neuron ids, at least n places (see compact_views)
+    :param steps: placeholder of the time steps, at least n places (see compact_views)
+    :return: the first time step, origin of the steps
+    """
+    return append_compact_spike_events(events, resolution, neurons, steps, 0, 0, 0)[0]
+
+
+def append_compact_spike_events(events, resolution, neurons, steps, size, first_step, last_step):
+    """
+    encode the events from NEST after the events already encoded, e.g. one package of NEST after the other
+    NOTE: the spike times are rounded to the resolution (exact for the spikes on the grid of NEST)
+    :param events: (n,3) events: id of device, id of neuron, spike time in ms
+    :param resolution: duration of a time step in ms
+    :param neurons: placeholder of the neuron ids, at least size+n places (see compact_views)
+    :param steps: placeholder of the time steps, at least size+n places (see compact_views)
+    :param size: number of events already encoded
+    :param first_step: origin of the steps of the events already encoded
+    :param last_step: last time step of the events already encoded
+    :return: the first and the last time steps of all the encoded events
+    """
+    if events.shape[0] == 0:
+        return first_step, last_step
+    time_steps = np.rint(events[:, 2] / resolution).astype(np.int64)
+    origin, last = int(time_steps.min()), int(time_steps.max())
+    if size > 0:
+        origin, last = min(origin, first_step), max(last, last_step)
+    if last - origin > np.iinfo(np.uint16).max:
+        raise Exception("compact events: the spikes of a step span more than "
+                        + str(np.iinfo(np.uint16).max) + " time steps")
+    if size > 0 and origin < first_step:
+        # the origin moves back: the steps already encoded are shifted
+        steps[:size] += np.uint16(first_step - origin)
+    neurons[size:size + events.shape[0]] = events[:, 1]
+    np.subtract(time_steps, origin, out=steps[size:size + events.shape[0]], casting='unsafe')
+    return origin, last
+
+
+def spike_events_of_compact(neurons, steps, first_step, resolution):
+    """
+    decode compact events, for the transformations which need the (n,3) layout
+    :param neurons: neuron ids
+    :param steps: time steps from the first step
+    :param first_step: origin of the steps
+    :param resolution: duration of a time step in ms
+    :return: (n,3) events: id of device (unknown: 0), id of neuron, spike time in ms
+    """
+    events = np.zeros((neurons.shape[0], 3))
+    events[:, 1] = neurons
+    events[:, 2] = (steps + np.int64(first_step)) * resolution
+    return events
+
+
+def rectangular_kernel(sigma, sampling_period, cutoff=5.0):
+    """
+    discretized rectangular kernel, sampled like elephant.statistics.instantaneous_rate
+    :param sigma: standard deviation of the kernel in ms
+    :param sampling_period: sampling period of the rate in ms
+    :param cutoff: width of the kernel in number of sigma (elephant default)
+    :return: the kernel values in Hz, odd number of points centered on the median
+    """
+    cutoff = max(cutoff, np.sqrt(3.0))  # minimal width allowed by elephant for this kernel
+    half = int(np.ceil(cutoff * sigma / sampling_period))
+    # times and half width of the kernel are expressed in number of sampling period
+    times = np.linspace(-cutoff * sigma / sampling_period, cutoff * sigma / sampling_period,
+                        num=2 * half + 1, endpoint=True)
+    tau = np.sqrt(3.0) * sigma / sampling_period
+    return (np.abs(times) < tau) * (MS_PER_SECOND / (2 * tau * sampling_period))
+
+
+class streaming_rate:
+    """
+    instantaneous rate of a population, computed step after step
+    The kernel is wider than a bin: the spikes of a step contribute to the first
+    bins of the following steps. This contribution is kept (overlap-add), so the
+    rate is smoothed across the boundaries of the steps and each step only bins
+    its new spikes.
+    """
+
+    def __init__(self, sampling_period, kernel):
+        """
+        :param sampling_period: size of the bin in ms
+        :param kernel: discretized kernel in Hz (see rectangular_kernel), centered
+        """
+        # the zeros at the borders of the kernel do not contribute
+        support = np.flatnonzero(kernel)
+        trim = min(support[0], kernel.shape[0] - 1 - support[-1]) if support.shape[0] > 0 else 0
+        self.kernel = np.array(kernel[trim:kernel.shape[0] - trim], dtype=np.float64)
+        self.sampling_period = sampling_period
+        self.half = (self.kernel.shape[0] - 1) // 2
+        # contribution of the previous steps to the next bins
+        self.carry = np.zeros(self.half)
+        # placeholder of the rate of the step and the contribution to the next steps, reused
+        self.__rate = np.zeros(0)
+
+    def partial(self, spike_times, t_start, t_stop):
+        """
+        smoothed histogram of spikes of the step, without the previous steps
+        the result is linear in the spikes: the partials of disjoint parts can be added
+        :param spike_times: spike times in ms
+        :param t_start: time of the first bin in ms
+        :param t_stop: end of the step in ms
+        :return: rate in Hz of the bins of the step followed by the contribution to the next bins
+        """
+        nb_bins = int((t_stop - t_start) / self.sampling_period)
+        hist, _ = np.histogram(spike_times, bins=nb_bins,
+                               range=(t_start, t_start + nb_bins * self.sampling_period))
+        return self._smooth(hist)
+
+    def partial_steps(self, steps, shift, nb_bins):
+        """
+        partial of the spikes given by time step, one bin by time step (see partial)
+        :param steps: time steps of the spikes (compact events)
+        :param shift: bin of the step 0
+        :param nb_bins: number of bins of the step
+        :return: rate in Hz of the bins of the step followed by the contribution to the next bins
+        """
+        counts = np.bincount(steps)
+        hist = np.zeros(nb_bins)
+        low, high = max(0, shift), min(nb_bins, shift + counts.shape[0])
+        if low < high:
+            hist[low:high] = counts[low - shift:high - shift]
+        return self._smooth(hist)
+
+    def _smooth(self, hist):
+        """
+        :param hist: number of spikes of each bin of the step
+        :return: convolution centered on the histogram, the tail is kept for the next step
+        """
+        return np.convolve(hist.astype(np.float64), self.kernel)[self.half:]
+
+    def update(self, partial):
+        """
+        rate of the step: add the contribution of the previous steps and keep the one to the next steps
+        NOTE: call it once by step, in the order of the steps
+        :param partial: sum of the partials of all the spikes of the step
+        :return: rate in Hz for each bin of the step (valid until the next update)
+        """
+        nb_bins = partial.shape[0] - self.half
+        if self.__rate.shape[0] != partial.shape[0]:
+            self.__rate = np.empty(partial.shape[0])
+        rate = self.__rate
+        np.copyto(rate, partial)
+        rate[:self.half] += self.carry
+        self.carry[:] = rate[nb_bins:]
+        rate = rate[:nb_bins]
+        np.clip(rate, a_min=0.0, a_max=None, out=rate)
+        return rate
+
+
+class spiketorate(transformer):
+    """
+    spike trains of NEST to mean rate of the population for TVB (NumPy, streaming)
+    The rate is linear in the spikes: the pivot can share the events between ranks
+    (partial_rate) and sum the results on one rank (rate).
+    """
+    input_layout = 'events'
+    output_layout = 'rate'
 
     def __init__(self,param):
         self.__logger = logging.getLogger("transformer--spiketorate")
-        handler = logging.StreamHandler(sys.stdout)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        self.__logger.addHandler(handler)
+        if not self.__logger.handlers:
+            # the logger is shared by all the instances: only one handler
+            handler = logging.StreamHandler(sys.stdout)
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            self.__logger.addHandler(handler)
         self.__logger.setLevel(logging.DEBUG)
         self.id = 0
         self.time_synch = param['time_synchronization']  # time of synchronization between 2 run
@@ -119,6 +401,11 @@ class spiketorate:
         self.nb_neurons = param['nb_neurons'][0]
         # self.first_id = 0
         self.first_id = param['id_first_neurons'][0]  # id of transformer is hardcoded to 0
+        self.sampling_period = self.dt - SAMPLING_PERIOD_MARGIN
+        # the state of the rate between two steps (only used by the rank which calls rate)
+        self.streaming = streaming_rate(self.sampling_period, rectangular_kernel(1.0, self.sampling_period))
+        # placeholder of the times of the step, reused
+        self.__times = np.empty(2, dtype='d')
 
 
     def spike_to_rate(self, count, size_buffer, buffer_of_spikes):
@@ -129,41 +416,111 @@ class spiketorate:
         :param buffer_of_spikes: buffer contains spikes
         :return: rate for the interval
         """
-        spikes_neurons = self._reshape_buffer_from_nest(count, size_buffer, buffer_of_spikes)
-        rates = instantaneous_rate(spikes_neurons,
-                                   t_start=np.around(count * self.time_synch, decimals=2) * ms,
-                                   t_stop=np.around((count + 1) * self.time_synch, decimals=2) * ms,
-                                   sampling_period=(self.dt - 0.000001) * ms, kernel=RectangularKernel(1.0 * ms))
-        rate = np.mean(rates, axis=1) / 10  # the division by 10 ia an adaptation for the model of TVB
-        times = np.array([count * self.time_synch, (count + 1) * self.time_synch], dtype='d')
-        return times, rate
+        return self.transform(count, spike_events(buffer_of_spikes, size_buffer))
+
+    def transform(self, count, events):
+        """
+        :param count: counter of the number of time of the transformation (identify the timing of the simulation)
+        :param events: (n,3) events: id of device, id of neuron, spike time
+        :return: times of the step and rate for the interval
+        """
+        return self.times(count), self.rate(self.partial_rate(count, events))
+
+    def times(self, count):
+        """
+        :param count: counter of the number of time of the transformation
+        :return: starting and ending time of the interval (valid until the next call)
+        """
+        self.__times[0] = count * self.time_synch
+        self.__times[1] = (count + 1) * self.time_synch
+        return self.__times
+
+    def partial_rate(self, count, events):
+        """
+        sum of the instantaneous rates of all the neurons, for a part of the spikes
+        the rates are linear in the spikes: the partial sums of disjoint parts can be added
+        :param count: counter of the number of time of the transformation (identify the timing of the simulation)
+        :param events: (n,3) events: id of device, id of neuron, spike time
+        :return: sum of the rates of the neurons in Hz for each bin, followed by the contribution to the next steps
+        """
+        t_start = np.around(count * self.time_synch, decimals=2)
+        t_stop = np.around((count + 1) * self.time_synch, decimals=2)
+        return self.streaming.partial(events[:, 2], t_start, t_stop)
+
+    def partial_rate_compact(self, count, neurons, steps, first_step):
+        """
+        partial_rate of compact events: the time steps are binned without conversion to times
+        :param count: counter of the number of time of the transformation (identify the timing of the simulation)
+        :param neurons: neuron ids
+        :param steps: time steps from the first step
+        :param first_step: origin of the steps
+        :return: sum of the rates of the neurons in Hz for each bin, followed by the contribution to the next steps
+        """
+        t_start = np.around(count * self.time_synch, decimals=2)
+        t_stop = np.around((count + 1) * self.time_synch, decimals=2)
+        nb_bins = int((t_stop - t_start) / self.sampling_period)
+        # a spike at the time step k is in the bin k - (step of t_start)
+        return self.streaming.partial_steps(steps, first_step - int(np.rint(t_start / self.dt)), nb_bins)
+
+    def rate(self, partial_rate):
+        """
+        mean rate of the population
+        NOTE: the rate of a step depends on the previous steps, call it once by step, in order
+        :param partial_rate: sum of the rates of the neurons (see partial_rate)
+        :return: rate for TVB (valid until the next call)
+        """
+        rate = self.streaming.update(partial_rate)
+        # NOTE: mean over the neurons, then conversion for TVB, in the order of np.mean(rates, axis=1) / 10
+        # of the former transformation: the same rounding (one multiplication by 0.1 / nb_neurons is not)
+        np.divide(rate, self.nb_neurons, out=rate)
+        np.divide(rate, RATE_DIVISOR_TVB, out=rate)
+        return rate
+
+
+class spiketorate_elephant(spiketorate):
+    """
+    reference of spiketorate with elephant (slow, for validation)
+    The kernel is truncated at the boundaries of the step: nothing is carried to the next steps.
+    """
+
+    def partial_rate(self, count, events):
+        """
+        sum of the instantaneous rates of all the neurons, for a part of the spikes
+        :param count: counter of the number of time of the transformation (identify the timing of the simulation)
+        :param events: (n,3) events: id of device, id of neuron, spike time
+        :return: sum of the rates of the neurons in Hz for each bin, followed by zeros for the next steps
+        """
+        t_start = np.around(count * self.time_synch, decimals=2)
+        t_stop = np.around((count + 1) * self.time_synch, decimals=2)
+        rates = np.zeros(int((t_stop - t_start) / self.sampling_period) + self.streaming.half)
+        if events.shape[0] > 0:
+            rates[:rates.shape[0] - self.streaming.half] = np.sum(instantaneous_rate(
+                self._reshape_buffer_from_nest(count, events), t_start=t_start * ms, t_stop=t_stop * ms,
+                sampling_period=self.sampling_period * ms, kernel=RectangularKernel(1.0 * ms)).magnitude, axis=1)
+        return rates
+
+    def partial_rate_compact(self, count, neurons, steps, first_step):
+        """
+        partial_rate of compact events, decoded to the (n,3) layout for elephant
+        """
+        return self.partial_rate(count, spike_events_of_compact(neurons, steps, first_step, self.dt))
 
-    def _reshape_buffer_from_nest(self, count, size_buffer, buffer):
+    def _reshape_buffer_from_nest(self, count, events):
         """
         get the spike time from the buffer and order them by neurons
         :param count: counter of the number of time of the transformation (identify the timing of the simulation)
-        :param size_buffer: size of the data in the buffer
-        :param buffer: buffer contains id of devices, id of neurons and spike times
-        :return:
+        :param events: (n,3) events: id of devices, id of neurons and spike times
+        :return: one spike train by neuron
         """
-        spikes_neurons = [[] for i in range(self.nb_neurons)]
-        # get all the time of the spike and add them in a histogram
-        for index_data in range(int(np.rint(size_buffer / 3))):
-            id_neurons = int(buffer[index_data * 3 + 1])
-            time_step = buffer[index_data * 3 + 2]
-            spikes_neurons[id_neurons - self.first_id].append(time_step)
-        for i in range(self.nb_neurons):
-            if len(spikes_neurons[i]) > 1:
-                spikes_neurons[i] = SpikeTrain(np.concatenate(spikes_neurons[i]) * ms,
-                                               t_start=np.around(count * self.time_synch, decimals=2),
-                                               t_stop=np.around((count + 1) * self.time_synch, decimals=2) + 0.0001)
-                                               
-            
-            else:
-                spikes_neurons[i] = SpikeTrain(spikes_neurons[i] * ms,
-                                               t_start=np.around(count * self.time_synch, decimals=2),
-                                               t_stop=np.around((count + 1) * self.time_synch, decimals=2) + 0.0001)
-        return spikes_neurons
+        id_neurons = events[:, 1].astype(np.int64) - self.first_id
+        # group the spike times by neurons (stable sort keeps the order of the spikes)
+        order = np.argsort(id_neurons, kind='stable')
+        bounds = np.searchsorted(id_neurons[order], np.arange(self.nb_neurons + 1))
+        spike_times = events[order, 2]
+        t_start = np.around(count * self.time_synch, decimals=2)
+        t_stop = np.around((count + 1) * self.time_synch, decimals=2) + 0.0001
+        return [SpikeTrain(spike_times[bounds[i]:bounds[i + 1]] * ms, t_start=t_start, t_stop=t_stop)
+                for i in range(self.nb_neurons)]
 
 
 ############
@@ -183,7 +540,33 @@ def toy_rates_to_spikes(rates,t_start,t_stop):
     times = np.around(np.sort(np.array(times)), decimals=1)
     return times
 
-class generate_data:
+def select_spike_trains(spikes, offsets, index):
+    """
+    select spike trains of a flat array of spike times (CSR layout) without python loop
+    :param spikes: spike times of all the trains, ordered by train
+    :param offsets: offsets of the trains (train i is spikes[offsets[i]:offsets[i+1]])
+    :param index: index of the selected trains
+    :return: number of spikes of each selected train and the concatenation of their spikes
+    """
+    index = np.asarray(index, dtype=np.int64)
+    starts = offsets[index]
+    lengths = offsets[index + 1] - starts
+    if index.shape[0] > 0 and np.all(np.diff(index) == 1):
+        # consecutive trains are already contiguous in memory: no copy
+        return lengths, spikes[starts[0]:starts[0] + np.sum(lengths)]
+    # position of each selected spike: start of its train + rank inside the train
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return lengths, spikes[np.arange(shift.shape[0]) + shift]
+
+
+class generate_data(transformer):
+    """
+    rate of TVB to independent spike trains of the spike generators of NEST (NumPy)
+    The spike generators are independent: the pivot can share them between ranks (first, last).
+    """
+    input_layout = 'rate'
+    output_layout = 'spike_trains'
+
     def __init__(self,param):
         """
         generate spike train for each neurons
@@ -191,10 +574,12 @@ class generate_data:
         :param nb_spike_generator: number of spike generator/neurons in each regions
         """
         self.__logger = logging.getLogger("transformer--generate_data")
-        handler = logging.StreamHandler(sys.stdout)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        self.__logger.addHandler(handler)
+        if not self.__logger.handlers:
+            # the logger is shared by all the instances: only one handler
+            handler = logging.StreamHandler(sys.stdout)
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            self.__logger.addHandler(handler)
         self.__logger.setLevel(logging.DEBUG)
 
         # self.percentage_shared = param['percentage_shared']  # percentage of shared rate between neurons
@@ -202,7 +587,12 @@ class generate_data:
         self.nb_spike_generator = param['nb_neurons']         # number of spike generator
         # self.nb_synapse = param['nb_brain_synapses']               # number of synapses by neurons
         # self.function_translation = param['function_select'] # choose the function for the translation
-        # np.random.seed(param['seed'])
+        self.seed = param['seed']
+        self.resolution = param['resolution']  # the resolution of NEST, grid of the spike times
+        # the random streams are specific to the hub (region of the proxy) and to the step,
+        # and to each block of generators: the trains do not depend on the partition between ranks
+        self.id_hub = int(param['id_nest_region'][0])
+        self.nb_generators_by_stream = int(param['nb_generators_by_stream'])
         
         # id_transformer = 0  # TODO check if it is correct
         # self.id = id_transformer  # TODO check if it is needed
@@ -218,59 +608,250 @@ class generate_data:
             self.save_rate_buf = None
         # self.logger.info('TRS : end init transformation')
         self.nb_synapse = int(param["nb_brain_synapses"])
-        
-    def generate_spike(self,count,time_step,rate):
+        # placeholder of the rate of the Poisson generators, reused
+        self.__rate = np.empty(0)
+
+    def transform(self, count, time_step, rate, first=0, last=None):
+        """
+        :param count: the number of step of synchronization between simulators
+        :param time_step: the time of synchronization
+        :param rate: the input rate of the mean field
+        :param first: index of the first spike generator
+        :param last: index after the last spike generator (default: all the generators)
+        :return: spike times of the generators and the offsets of each generator
+        """
+        return self.generate_spike(count, time_step, rate, first, last)
+
+    def generate_spike(self,count,time_step,rate,first=0,last=None):
+        """
+        generate the spike trains of the spike generators [first, last)
+        :param count: the number of step of synchronization between simulators
+        :param time_step: the time of synchronization
+        :param rate: the input rate of the mean field
+        :param first: index of the first spike generator
+        :param last: index after the last spike generator (default: all the generators)
+        :return: spike times of the generators and the offsets of each generator
+                 (generator first+i is spikes[offsets[i]:offsets[i+1]])
+        """
+        if last is None:
+            last = self.nb_spike_generator[0]
         #if time_step[0] == -1e5:
         #    self.get_time_rate_exit = True
         #    self.logger.info("MPI Internal : rate(get) : times"+str(self.sender_rank))
         #    return times, None
-        rate *= self.nb_synapse  # rate of poisson generator ( due property of poisson process)
-        rate += 1e-12
-        rate = np.abs(rate)  # avoid rate equals to zeros
-        signal = AnalogSignal(rate * Hz, t_start=(time_step[0] + 0.1) * ms,
-                              sampling_period=(time_step[1] - time_step[0]) / rate.shape[-1] * ms)
-        spike_generate = []
-        # print("rate:",rate,"\nsignal:",signal,"\ntime step:",time_step)
-        for i in range(self.nb_spike_generator[0]):
-            # generate individual spike trains
-            spike_generate.append(np.around(np.sort(inhomogeneous_poisson_process(signal, as_array=True)), decimals=1))
-        return spike_generate
-       
-       
-        # """
-        # generate spike
-        # This function are based on the paper : Kuhn, Alexandre, Ad Aertsen, and Stefan Rotter. “Higher-Order Statistics of Input Ensembles and the Response of Simple Model Neurons.” Neural Computation 15, no. 1 (January 2003): 67–101. https://doi.org/10.1162/089976603321043702.
-        # DOI: 10.1162/089976603321043702
-        # function 1 : Single Interaction Process Model
-        # function 2 : Multiple Interaction Process Model
-        # :param count: the number of step of synchronization between simulators
-        # :param time_step: the time of synchronization
-        # :param rate: the input rate of the mean field
-        # :return:
-        # """
-        # if self.function_translation == 1:
-        #     # Single Interaction Process Model
-        #     # Compute the rate to spike trains
-        #     rate *= self.nb_synapse # rate of poisson generator ( due property of poisson process)
-        #     rate += 1e-12 # avoid rate equals to zeros
-        #     spike_shared = \
-        #         rates_to_spikes(rate * self.percentage_shared * Hz,
-        #                         time_step[0] * ms, time_step[1] * ms, variation=True)[0]
-        #     spike_generate = rates_to_spikes(np.repeat([rate],self.nb_spike_generator,axis=0) * (1 - self.percentage_shared) * Hz, time_step[0] * ms, time_step[1] * ms,
-        #                             variation=True)
-        #     for i in range(self.nb_spike_generator):
-        #         spike_generate[i] = np.around(np.sort(np.concatenate((spike_generate, spike_shared))), decimals=1)
-        #     #self.logger.info('rate :'+str(rate)+' spikes :'+str(np.concatenate(spike_generate).shape))
-        #     return spike_generate
-        # elif self.function_translation == 2:
-        #     # Multiple Interaction Process Model
-        #     rate *= self.nb_synapse / self.percentage_shared # rate of poisson generator ( due property of poisson process)
-        #     rate += 1e-12  # avoid rate equals to zeros
-        #     spike_shared = np.round(rates_to_spikes(rate * Hz, time_step[0] * ms, time_step[1] * ms, variation=True)[0],1)
-        #     select = np.random.binomial(n=1,p=self.percentage_shared,size=(self.nb_spike_generator,spike_shared.shape[0]))
-        #     result = []
-        #     for i in np.repeat([spike_shared],self.nb_spike_generator,axis=0)*select :
-        #         result.append(i[np.where(i!=0)])
-        #     #self.logger.info('rate :'+str(rate)+' spikes :'+str(spike_shared))
-        #     return result
-    
+        # rate of poisson generator ( due property of poisson process)
+        # NOTE: rate is a view of the shared buffer, it is not modified
+        rate = self._poisson_rate(rate)
+        # the spikes of NEST start one time step after the beginning of the window
+        t_start = time_step[0] + self.resolution
+        sampling_period = (time_step[1] - time_step[0]) / rate.shape[-1]
+        spikes, offsets = self._spike_trains(count, rate, t_start, sampling_period, first, last)
+        # the spikes are a new array: rounded in place to the grid of NEST
+        np.divide(spikes, self.resolution, out=spikes)
+        np.rint(spikes, out=spikes)
+        return np.multiply(spikes, self.resolution, out=spikes), offsets
+
+    def _poisson_rate(self, rate):
+        """
+        rate of the Poisson generators, computed in place in a reused placeholder
+        :param rate: the input rate of the mean field in Hz
+        :return: rate in Hz, never zero (valid until the next call)
+        """
+        if self.__rate.shape != rate.shape:
+            self.__rate = np.empty(rate.shape)
+        poisson_rate = self.__rate
+        np.multiply(rate, self.nb_synapse, out=poisson_rate)
+        poisson_rate += MIN_RATE  # avoid rate equals to zeros
+        np.abs(poisson_rate, out=poisson_rate)
+        return poisson_rate
+
+    def _spike_trains(self, count, rate, t_start, sampling_period, first, last):
+        """
+        :return: spike times of the generators [first, last) and the offsets of each generator
+        """
+        return self._by_stream(count, first, last,
+                               lambda rng, nb_trains: inhomogeneous_poisson_trains(rng, rate, t_start,
+                                                                                   sampling_period, nb_trains))
+
+    def _rng(self, count, stream):
+        """
+        random stream of a step, derived from the seed by SeedSequence spawning
+        The key (hub, step, stream) gives the stream directly: the same whatever the order
+        of the calls, the rank or the thread which draws it.
+        :param count: the number of step of synchronization between simulators
+        :param stream: 0: shared by all the generators, 1 + i: block i of generators (see _by_stream)
+        :return: numpy random generator
+        """
+        return np.random.Generator(np.random.PCG64(
+            np.random.SeedSequence(self.seed, spawn_key=(self.id_hub, count, stream))))
+
+    def _shared_rng(self, count):
+        """
+        random stream of the spikes shared by all the generators, the same on all the ranks
+        :param count: the number of step of synchronization between simulators
+        :return: numpy random generator
+        """
+        return self._rng(count, 0)
+
+    def _by_stream(self, count, first, last, draw):
+        """
+        spike trains of the generators [first, last), drawn by blocks of nb_generators_by_stream generators
+        Each block has its own random stream: the trains of a generator are the same
+        whatever the partition of the generators between ranks or threads.
+        :param count: the number of step of synchronization between simulators
+        :param first: index of the first spike generator
+        :param last: index after the last spike generator
+        :param draw: function(rng, nb_trains) -> spike times and offsets of the trains of a block
+        :return: spike times of the generators [first, last) and the offsets of each generator
+        """
+        size = self.nb_generators_by_stream
+        spikes, lengths = [np.empty(0)], [np.empty(0, dtype=np.int64)]
+        for block in range(first // size, -(-last // size)):
+            begin = block * size
+            end = min(begin + size, self.nb_spike_generator[0])
+            times, offsets = draw(self._rng(count, 1 + block), end - begin)
+            # only the trains of [first, last), when the range is not aligned on the blocks
+            low, high = max(first, begin) - begin, min(last, end) - begin
+            spikes.append(times[offsets[low]:offsets[high]])
+            lengths.append(np.diff(offsets[low:high + 1]))
+        offsets = np.zeros(last - first + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+        return np.concatenate(spikes), offsets
+
+
+class generate_data_elephant(generate_data):
+    """
+    reference of generate_data with elephant (slow, for validation)
+    """
+
+    def _spike_trains(self, count, rate, t_start, sampling_period, first, last):
+        """
+        :return: spike times of the generators [first, last) and the offsets of each generator
+        """
+        signal = AnalogSignal(rate * Hz, t_start=t_start * ms, sampling_period=sampling_period * ms)
+
+        def draw(rng, nb_trains):
+            # NOTE: elephant draws from the global random state, seeded by the stream of the block
+            np.random.seed(rng.integers(2 ** 32, size=4, dtype=np.uint32))
+            spike_generate = [np.sort(inhomogeneous_poisson_process(signal, as_array=True))
+                              for i in range(nb_trains)]
+            offsets = np.zeros(nb_trains + 1, dtype=np.int64)
+            np.cumsum([train.shape[0] for train in spike_generate], out=offsets[1:])
+            return np.concatenate([np.empty(0)] + spike_generate), offsets
+
+        return self._by_stream(count, first, last, draw)
+
+
+class generate_data_sip(generate_data):
+    """
+    correlated spike trains: Single Interaction Process Model
+    Kuhn, Alexandre, Ad Aertsen, and Stefan Rotter. "Higher-Order Statistics of Input Ensembles
+    and the Response of Simple Model Neurons." Neural Computation 15, no. 1 (2003): 67-101.
+    DOI: 10.1162/089976603321043702
+    Each train is an independent train (rate x (1 - percentage_shared)) merged with
+    one train shared by all the generators (rate x percentage_shared).
+    """
+
+    def __init__(self, param):
+        super().__init__(param)
+        self.percentage_shared = float(param['percentage_shared'])  # percentage of shared rate between neurons
+        if not 0.0 <= self.percentage_shared <= 1.0:
+            raise Exception("percentage_shared must be in [0, 1] : " + str(self.percentage_shared))
+
+    def _spike_trains(self, count, rate, t_start, sampling_period, first, last):
+        """
+        :return: spike times of the generators [first, last) and the offsets of each generator
+        """
+        # the shared train only depends on the step: the same on all the ranks
+        shared, _ = inhomogeneous_poisson_trains(self._shared_rng(count),
+                                                 rate * self.percentage_shared, t_start, sampling_period, 1)
+        own_rate = rate * (1 - self.percentage_shared)
+        own, own_offsets = self._by_stream(count, first, last,
+                                           lambda rng, nb_trains: inhomogeneous_poisson_trains(
+                                               rng, own_rate, t_start, sampling_period, nb_trains))
+        # each train: its own spikes followed by the shared spikes, then sorted inside the train
+        nb_trains = last - first
+        lengths = np.diff(own_offsets) + shared.shape[0]
+        offsets = np.zeros(nb_trains + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        trains = np.repeat(np.arange(nb_trains), lengths)
+        # position of the shared spikes in each train
+        is_shared = np.arange(offsets[-1]) - offsets[trains] >= np.diff(own_offsets)[trains]
+        times = np.empty(offsets[-1])
+        times[~is_shared] = own
+        times[is_shared] = np.tile(shared, nb_trains)
+        return times[np.lexsort((times, trains))], offsets
+
+
+class generate_data_mip(generate_data):
+    """
+    correlated spike trains: Multiple Interaction Process Model
+    Kuhn, Alexandre, Ad Aertsen, and Stefan Rotter. "Higher-Order Statistics of Input Ensembles
+    and the Response of Simple Model Neurons." Neural Computation 15, no. 1 (2003): 67-101.
+    DOI: 10.1162/089976603321043702
+    One mother train (rate / percentage_shared) is shared by all the generators,
+    each train keeps each spike of the mother train with the probability percentage_shared.
+    """
+
+    def __init__(self, param):
+        super().__init__(param)
+        self.percentage_shared = float(param['percentage_shared'])  # percentage of shared rate between neurons
+        if not 0.0 < self.percentage_shared <= 1.0:
+            raise Exception("percentage_shared must be in ]0, 1] : " + str(self.percentage_shared))
+
+    def _spike_trains(self, count, rate, t_start, sampling_period, first, last):
+        """
+        :return: spike times of the generators [first, last) and the offsets of each generator
+        """
+        # the mother train only depends on the step: the same on all the ranks
+        mother, _ = inhomogeneous_poisson_trains(self._shared_rng(count),
+                                                 rate / self.percentage_shared, t_start, sampling_period, 1)
+        return self._by_stream(count, first, last, lambda rng, nb_trains: self._select(rng, mother, nb_trains))
+
+    def _select(self, rng, mother, nb_trains):
+        """
+        selection of the spikes of the mother train by each generator of a block, in one array
+        :param rng: random stream of the block
+        :param mother: spike times of the mother train
+        :param nb_trains: number of generators of the block
+        :return: spike times of the trains and the offsets of each train
+        """
+        select = rng.random((nb_trains, mother.shape[0])) < self.percentage_shared
+        offsets = np.zeros(nb_trains + 1, dtype=np.int64)
+        np.cumsum(np.count_nonzero(select, axis=1), out=offsets[1:])
+        # the selection is ordered by train then by spike: the trains stay sorted
+        return mother[np.nonzero(select)[1]], offsets
+
+
+############
+# Registry of the transformers
+############
+# kind of transformation -> name -> class of the transformer
+TRANSFORMERS = {
+    'spike_to_rate': {'numpy': spiketorate, 'elephant': spiketorate_elephant},
+    'rate_to_spike': {'numpy': generate_data, 'elephant': generate_data_elephant,
+                      'sip': generate_data_sip, 'mip': generate_data_mip},
+}
+
+
+def register_transformer(kind, name, transformer_class):
+    """
+    add a transformer to the registry (plug-in)
+    :param kind: kind of transformation, e.g. 'spike_to_rate'
+    :param name: name of the transformer, used in the parameters
+    :param transformer_class: subclass of transformer
+    """
+    TRANSFORMERS.setdefault(kind, {})[name] = transformer_class
+
+
+def create_transformer(kind, name, param):
+    """
+    create a transformer of the registry
+    :param kind: kind of transformation, e.g. 'spike_to_rate'
+    :param name: name of the transformer, e.g. 'numpy' (fast) or 'elephant' (reference)
+    :param param: parameters of the InterscaleHub
+    :return: the transformer
+    """
+    if kind not in TRANSFORMERS or name not in TRANSFORMERS[kind]:
+        raise Exception("unknown transformer : " + str(kind) + " " + str(name))
+    return TRANSFORMERS[kind][name](param)
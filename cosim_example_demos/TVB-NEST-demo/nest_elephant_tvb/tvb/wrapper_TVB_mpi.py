@@ -40,6 +40,15 @@ def run_mpi(simulator, path, logger):
     comm_send = []
     for i in id_proxy:
         comm_send.append(init_mpi(path_receive + str(i) + ".txt", logger))
+    # placeholders of the messages, reused at each step
+    # one message by step and proxy: [start_time, end_time, rates...]
+    frame_receive = [np.empty(time_synch_n + 2, dtype='d') for i in id_proxy]
+    frame_send = [np.empty(time_synch_n + 2, dtype='d') for i in id_proxy]
+    # persistent requests of the messages of fixed size, reused at each step
+    check = np.empty(1, dtype='b')
+    next_part = np.ones(1, dtype='b')
+    request_accept = [comm.Recv_init([check, 1, MPI.BOOL], source=0, tag=0) for comm in comm_send]
+    request_next_part = [comm.Send_init([next_part, 1, MPI.BOOL], dest=0, tag=0) for comm in comm_receive]
 
     logger.info("send initialisation of TVB : prepare data")
     initialisation_data = []
@@ -49,7 +58,7 @@ def run_mpi(simulator, path, logger):
     time_init = [0, time_synch]
     logger.info("send initialisation of TVB : send data")
     for index, comm in enumerate(comm_send):
-        send_mpi(comm, time_init, initialisation_data[:, index] * 1e3, logger)
+        send_mpi(comm, time_init, initialisation_data[:, index] * 1e3, logger, frame_send[index], request_accept[index])
 
     # the loop of the simulation
     count = 0
@@ -57,8 +66,8 @@ def run_mpi(simulator, path, logger):
         logger.info(" TVB receive data start")
         # receive MPI data
         data_value = []
-        for comm in comm_receive:
-            receive = receive_mpi(comm, logger)
+        for index, comm in enumerate(comm_receive):
+            receive = receive_mpi(comm, logger, frame_receive[index], request_next_part[index])
             time_data = receive[0]
             data_value.append(receive[1])
         logger.info(" TVB receive data values")
@@ -87,12 +96,14 @@ def run_mpi(simulator, path, logger):
         times = [nest_data[0][0], nest_data[0][-1]]
         rate = np.concatenate(nest_data[1][:, 0, [id_proxy], 0])
         for index, comm in enumerate(comm_send):
-            send_mpi(comm, times, rate[:, index] * 1e3, logger)
+            send_mpi(comm, times, rate[:, index] * 1e3, logger, frame_send[index], request_accept[index])
 
         # increment of the loop
         count += 1
     # save the last part
     logger.info(" TVB finish")
+    for request in request_accept + request_next_part:
+        request.Free()
     for index, comm in enumerate(comm_send):
         logger.info('end comm send')
         end_mpi(comm, path + "/transformation/receive_from_tvb/" + str(id_proxy[index]) + ".txt", True, logger)
@@ -126,54 +137,62 @@ def init_mpi(path, logger):
     return comm
 
 
-def send_mpi(comm, times, data, logger):
+def send_mpi(comm, times, data, logger, frame=None, request=None):
     """
     send mpi data
     :param comm: MPI communicator
     :param times: times of values
     :param data: rates inputs
     :param logger: logger of the modules
+    :param frame: placeholder of the message, reused if it is large enough
+    :param request: persistent request of the reception of the acceptance
     :return:nothing
     """
     logger.info("start send")
     status_ = MPI.Status()
     # wait until the transformer accept the connections
-    accept = False
-    while not accept:
-        req = comm.irecv(source=0, tag=0)
-        accept = req.wait(status_)
-        logger.info("send accept")
+    if request is None:
+        comm.Recv([np.empty(1, dtype='b'), 1, MPI.BOOL], source=0, tag=0, status=status_)
+    else:
+        request.Start()
+        request.Wait(status_)
+    logger.info("send accept")
     source = status_.Get_source()  # the id of the excepted source
-    logger.info("get source")
-    data = np.ascontiguousarray(data, dtype='d')  # format the rate for sending
-    shape = np.array(data.shape[0], dtype='i')  # size of data
-    times = np.array(times, dtype='d')  # time of starting and ending step
-    comm.Send([times, MPI.DOUBLE], dest=source, tag=0)
-    comm.Send([shape, MPI.INT], dest=source, tag=0)
-    comm.Send([data, MPI.DOUBLE], dest=source, tag=0)
+    # times and rates in one message, the size of data is given by the message
+    if frame is None or frame.shape[0] < data.size + 2:
+        frame = np.empty(data.size + 2, dtype='d')
+    frame = frame[:data.size + 2]
+    frame[:2] = times  # time of starting and ending step
+    frame[2:].reshape(data.shape)[...] = data  # the rates of the proxy, flattened
+    comm.Send([frame, MPI.DOUBLE], dest=source, tag=0)
     logger.info("end send")
 
 
-def receive_mpi(comm, logger):
+def receive_mpi(comm, logger, frame=None, request=None):
     """
         receive proxy values the
     :param comm: MPI communicator
     :param logger: logger of the modules
-    :return: rate of all proxy
+    :param frame: placeholder of the message, reused if it is large enough
+    :param request: persistent request of the sending of the demand
+    :return: rate of all proxy (valid until the next use of the frame)
     """
     logger.info("start receive")
     status_ = MPI.Status()
     # send to the transformer : I want the next part
-    req = comm.isend(True, dest=0, tag=0)
-    req.wait()
-    time_step = np.empty(2, dtype='d')
-    comm.Recv([time_step, 2, MPI.DOUBLE], source=0, tag=MPI.ANY_TAG, status=status_)
-    # get the size of the rate
-    size = np.empty(1, dtype='i')
-    comm.Recv([size, MPI.INT], source=0, tag=0)
-    # get the rate
-    rates = np.empty(size, dtype='d')
-    comm.Recv([rates, size, MPI.DOUBLE], source=0, tag=MPI.ANY_TAG, status=status_)
+    if request is None:
+        comm.Send([np.ones(1, dtype='b'), 1, MPI.BOOL], dest=0, tag=0)
+    else:
+        request.Start()
+        request.Wait()
+    # one message: [start_time, end_time, rates...]
+    message = comm.Mprobe(source=0, tag=MPI.ANY_TAG, status=status_)
+    size = status_.Get_count(MPI.DOUBLE)
+    if frame is None or frame.shape[0] < size:
+        frame = np.empty(size, dtype='d')
+    frame = frame[:size]
+    message.Recv([frame, MPI.DOUBLE])
+    time_step, rates = frame[:2], frame[2:]
     logger.info("end receive " + str(time_step))
     # print the summary of the data
     if status_.Get_tag() == 0:
@@ -203,10 +222,7 @@ def end_mpi(comm, path, sending, logger):
         status_ = MPI.Status()
         # wait until the transformer accept the connections
         logger.info("TVB send check")
-        accept = False
-        while not accept:
-            req = comm.irecv(source=0, tag=0)
-            accept = req.wait(status_)
+        comm.Recv([np.empty(1, dtype='b'), 1, MPI.BOOL], source=0, tag=0, status=status_)
         logger.info("TVB send end simulation")
         source = status_.Get_source()  # the id of the excepted source
         times = np.array([0., 0.], dtype='d')  # time of starting and ending step
@@ -214,8 +230,7 @@ def end_mpi(comm, path, sending, logger):
     else:
         logger.info("TVB close connection receive " + port)
         # send to the transformer : I want the next part
-        req = comm.isend(True, dest=0, tag=1)
-        req.wait()
+        comm.Send([np.ones(1, dtype='b'), 1, MPI.BOOL], dest=0, tag=1)
     # closing the connection at this end
     logger.info("TVB disconnect communication")
     comm.Disconnect()
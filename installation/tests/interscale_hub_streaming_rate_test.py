@@ -0,0 +1,59 @@
+#
+# Testing the rate of the spiketorate transformer of the InterscaleHub:
+# the rate computed step after step (carry of the kernel between the steps) is the one of the
+# smoothing of all the spikes until the end of the step
+# run with cosim_example_demos/TVB-NEST-demo/nest_elephant_tvb in the PYTHONPATH
+#
+import numpy
+
+from Interscale_hub.transformer import spiketorate, compact_spike_events, RATE_DIVISOR_TVB
+
+param = {'time_synchronization': 1.2, 'resolution': 0.1, 'nb_neurons': [100], 'id_first_neurons': [1]}
+nb_steps = 20
+
+rng = numpy.random.default_rng(42)
+steps_by_synchronization = int(round(param['time_synchronization'] / param['resolution']))
+# spikes inside the time steps (no spike on the boundary of a bin)
+steps_of_spikes = rng.integers(0, nb_steps * steps_by_synchronization, size=5000)
+times = (steps_of_spikes + 0.3) * param['resolution']
+neurons = rng.integers(param['id_first_neurons'][0], param['id_first_neurons'][0] + param['nb_neurons'][0],
+                       size=times.shape[0])
+events = numpy.stack([numpy.zeros(times.shape[0]), neurons, times], axis=1)
+
+streaming = spiketorate(param)
+streaming_compact = spiketorate(param)
+rates = []
+for count in range(nb_steps):
+    t_start = numpy.around(count * param['time_synchronization'], decimals=2)
+    t_stop = numpy.around((count + 1) * param['time_synchronization'], decimals=2)
+    events_step = events[steps_of_spikes // steps_by_synchronization == count]
+    time_step, rate = streaming.transform(count, events_step)
+    assert numpy.allclose(time_step, [t_start, t_stop]), (count, time_step)
+    rates.append(rate.copy())
+    # the compact events give the same rate
+    compact_neurons = numpy.empty(events_step.shape[0], numpy.int32)
+    compact_steps = numpy.empty(events_step.shape[0], numpy.uint16)
+    first_step = compact_spike_events(events_step, param['resolution'], compact_neurons, compact_steps)
+    rate_compact = streaming_compact.rate(streaming_compact.partial_rate_compact(count, compact_neurons,
+                                                                                 compact_steps, first_step))
+    assert numpy.allclose(rate_compact, rate, rtol=0.0, atol=1e-12), count
+rates = numpy.concatenate(rates)
+
+# reference: for each step, histogram of all the spikes until the end of the step (the next steps are
+# not known yet) and convolution with the kernel, centered
+kernel = streaming.streaming.kernel
+half = streaming.streaming.half
+nb_bins = rates.shape[0] // nb_steps
+hist, _ = numpy.histogram(events[:, 2], bins=nb_steps * nb_bins,
+                          range=(0.0, nb_steps * nb_bins * streaming.sampling_period))
+expected = []
+for count in range(nb_steps):
+    history = hist[:(count + 1) * nb_bins]
+    expected.append(numpy.convolve(history, kernel)[half + count * nb_bins:half + (count + 1) * nb_bins])
+expected = numpy.clip(numpy.concatenate(expected), 0.0, None) / param['nb_neurons'][0] / RATE_DIVISOR_TVB
+assert rates.shape == expected.shape, (rates.shape, expected.shape)
+assert numpy.allclose(rates, expected, rtol=0.0, atol=1e-12), numpy.max(numpy.abs(rates - expected))
+# the kernel is wider than a step: the spikes of a step contribute to the next steps
+assert half > nb_bins
+
+print('InterscaleHub streaming rate OKAY!')
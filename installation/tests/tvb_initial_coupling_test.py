@@ -0,0 +1,41 @@
+#
+# Testing the initial coupling of the TVB wrapper:
+# the coupling computed for all the steps at once is the one of the loop over the steps of TVB
+#
+import numpy
+
+import tvb.simulator.lab as lab
+from tvb.contrib.cosimulation.cosimulator import CoSimulator
+from tvb.contrib.cosimulation.cosim_monitors import CosimCoupling
+
+from action_adapters_alphabrunel.tvb_simulator import initial_coupling
+
+rng = numpy.random.default_rng(42)
+nb_regions = 8
+weights = rng.random((nb_regions, nb_regions)) * (rng.random((nb_regions, nb_regions)) > 0.3)
+numpy.fill_diagonal(weights, 0.0)
+tract_lengths = rng.uniform(10.0, 40.0, (nb_regions, nb_regions))
+connectivity = lab.connectivity.Connectivity(weights=weights, tract_lengths=tract_lengths,
+                                             region_labels=numpy.array([str(i) for i in range(nb_regions)]),
+                                             centres=rng.random((nb_regions, 3)),
+                                             speed=numpy.array([4.0]))
+
+for coupling in (lab.coupling.Linear(a=numpy.array([0.154])), lab.coupling.Difference(),
+                 lab.coupling.Kuramoto()):
+    for proxies in ([0], [2], [1, 4], [0, 3, 7]):
+        simulator = CoSimulator(voi=numpy.array([0]), synchronization_time=1.2,
+                                cosim_monitors=(CosimCoupling(coupling=coupling),),
+                                proxy_inds=numpy.array(proxies, dtype=int),
+                                model=lab.models.Generic2dOscillator(),
+                                connectivity=connectivity, coupling=coupling,
+                                integrator=lab.integrators.HeunDeterministic(dt=0.1),
+                                monitors=(lab.monitors.Raw(),))
+        simulator.configure()
+        nb_steps = int(numpy.around(simulator.synchronization_time / simulator.integrator.dt))
+        expected = numpy.concatenate([simulator._loop_compute_node_coupling(step)[:, proxies, :]
+                                      for step in range(nb_steps)])
+        result = initial_coupling.initial_coupling(simulator, nb_steps, proxies)
+        assert result.shape == expected.shape, (type(coupling).__name__, proxies, result.shape)
+        assert numpy.allclose(result, expected), (type(coupling).__name__, proxies)
+
+print('TVB initial coupling OKAY!')